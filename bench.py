@@ -0,0 +1,503 @@
+"""Бенчмарки горячих путей бота. Запуск: python bench.py <сценарий> [--rows N]"""
+import argparse
+import asyncio
+import hashlib
+import itertools
+import json
+import logging
+import os
+import random
+import resource
+import tempfile
+import time
+import tracemalloc
+from dataclasses import dataclass
+
+import openai
+import pandas as pd
+from aiohttp import web, ClientSession
+
+import main
+
+COMPLEXES = [f"ЖК Тест {i}" for i in range(60)]
+CITIES = ["Краснодар", "Ростов-на-Дону", "Сочи", "Анапа", "Новороссийск"]
+
+
+def make_synthetic_frame(rows, seed=1):
+    """Синтетический прайс-лист в формате выгрузки с Яндекс.Диска (исходные имена столбцов)."""
+    rnd = random.Random(seed)
+    records = []
+    for i in range(rows):
+        rooms = rnd.choice(["Студия", "1", "2", "3", "4"])
+        area = round(rnd.uniform(22, 120), 1)
+        price = int(area * rnd.uniform(80_000, 160_000))
+        discounted = price - rnd.choice([0, 0, 0, 100_000, 250_000])
+        records.append({
+            "Жилой комплекс Раздел 1": rnd.choice(COMPLEXES),
+            "Город": rnd.choice(CITIES),
+            "Литер Раздел 2": f"Литер {rnd.randint(1, 12)}",
+            "Подъезд Раздел 3": rnd.randint(1, 6),
+            "Этаж": rnd.randint(1, 25),
+            "Номер квартиры": i + 1,
+            "Цена": price,
+            "Цена со скидкой": discounted,
+            "Цена за м2": round(price / area),
+            "Цена за кв.м. со скидкой": round(discounted / area),
+            "Комнат": rooms,
+            "Площадь": area,
+            "Продано": rnd.random() < 0.3,
+            "Бронь": rnd.random() < 0.05,
+            "Акция": rnd.choice(["", "", "", "Скидка 5%", "Ипотека 0.1%"]),
+            "ДКП": rnd.choice(["ДДУ", "ДКП"]),
+            "Очередь": rnd.randint(1, 4),
+            "Литер": f"Литер {rnd.randint(1, 12)}",
+            "Подъезд": rnd.randint(1, 6),
+            "Дата обновления": "2024-12-01",
+            "Картинка для анонса": "https://example.com/image.jpg",
+            "Путь до картинок": "/images/plan.png",
+        })
+    return pd.DataFrame.from_records(records)
+
+
+def make_synthetic_csv(path, rows, seed=1):
+    make_synthetic_frame(rows, seed).to_csv(path, sep=";", index=False)
+    return path
+
+
+async def start_stub_server(routes):
+    """Поднимает локальный aiohttp-сервер вместо внешнего API. routes: [(метод, путь, обработчик)]."""
+    app = web.Application()
+    for method, path, handler in routes:
+        app.router.add_route(method, path, handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}"
+
+
+def _percentile(samples, p):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+
+def bench_inventory(args):
+    rows = args.rows
+    with tempfile.TemporaryDirectory() as tmp:
+        path = make_synthetic_csv(os.path.join(tmp, "data.csv"), rows)
+
+        tracemalloc.start()
+        started = time.perf_counter()
+        inventory = main.load_inventory(path)
+        load_time = time.perf_counter() - started
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    memory = inventory.memory_usage()
+    print(f"Строк: {len(inventory)}")
+    print(f"Загрузка: {load_time:.2f} с, пик памяти при загрузке: {peak / 2**20:.1f} МБ")
+    print(f"Память инвентаря: {memory / 2**20:.1f} МБ ({memory / 2**20 * 100_000 / rows:.1f} МБ на 100k строк)")
+
+    queries = {
+        "2-комн., Краснодар, до 6 млн, свободные": dict(rooms=2, city="Краснодар", price_max=6_000_000),
+        "ЖК + комнатность": dict(complex_name=COMPLEXES[0], rooms=1),
+        "только ценовой диапазон": dict(price_min=4_000_000, price_max=5_000_000),
+    }
+    for title, filters in queries.items():
+        for fetch in (inventory.find_positions, inventory.find):
+            samples = []
+            for _ in range(200):
+                started = time.perf_counter()
+                result = fetch(**filters)
+                samples.append(time.perf_counter() - started)
+            print(
+                f"{title} [{fetch.__name__}]: {len(result)} строк, "
+                f"p50 {_percentile(samples, 50) * 1e6:.0f} мкс, p99 {_percentile(samples, 99) * 1e6:.0f} мкс"
+            )
+
+
+def bench_reload(args, changed=300):
+    rows = args.rows
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "data.csv")
+        frame = make_synthetic_frame(rows)
+        frame.to_csv(path, sep=";", index=False)
+        inventory = main.load_inventory(path)
+
+        # Несколько сотен изменений цен, продаж и акций, плюс новые и удалённые квартиры
+        rnd = random.Random(2)
+        for i in rnd.sample(range(rows), changed):
+            column = rnd.choice(["Цена со скидкой", "Продано", "Акция"])
+            if column == "Цена со скидкой":
+                frame.loc[i, column] -= 150_000
+            elif column == "Продано":
+                frame.loc[i, column] = True
+            else:
+                frame.loc[i, column] = "Скидка 10%"
+        extra = make_synthetic_frame(20, seed=3)
+        extra["Номер квартиры"] += rows
+        frame = pd.concat([frame.drop(index=range(10)), extra], ignore_index=True)
+        frame.to_csv(path, sep=";", index=False)
+
+        started = time.perf_counter()
+        main.load_inventory(path)
+        full_time = time.perf_counter() - started
+
+        started = time.perf_counter()
+        updated, changes = main.load_inventory_delta(inventory, path)
+        delta_time = time.perf_counter() - started
+
+    print(f"Строк: {len(updated)}")
+    print(f"Полная перезагрузка: {full_time * 1000:.0f} мс")
+    print(f"Инкрементальная перезагрузка: {delta_time * 1000:.0f} мс")
+    print(f"Изменения: {changes.summary()}")
+
+
+async def _bench_http(requests):
+    async def ok(request):
+        return web.json_response({"ok": True})
+
+    runner, base_url = await start_stub_server([("GET", "/ping", ok)])
+    try:
+        unpooled = []
+        for _ in range(requests):
+            started = time.perf_counter()
+            async with ClientSession() as session:
+                async with session.get(f"{base_url}/ping") as response:
+                    await response.read()
+            unpooled.append(time.perf_counter() - started)
+
+        pooled = []
+        session = main.create_http_session()
+        try:
+            for _ in range(requests):
+                started = time.perf_counter()
+                async with session.get(f"{base_url}/ping") as response:
+                    await response.read()
+                pooled.append(time.perf_counter() - started)
+        finally:
+            await session.close()
+    finally:
+        await runner.cleanup()
+
+    for title, samples in (("Новая сессия на запрос", unpooled), ("Общий пул", pooled)):
+        print(
+            f"{title}: p50 {_percentile(samples, 50) * 1000:.2f} мс, "
+            f"p99 {_percentile(samples, 99) * 1000:.2f} мс"
+        )
+
+
+def bench_http(args):
+    asyncio.run(_bench_http(args.requests))
+
+
+def bench_startup(args):
+    rows = args.rows
+    with tempfile.TemporaryDirectory() as tmp:
+        path = make_synthetic_csv(os.path.join(tmp, "data.csv"), rows)
+        snapshot_dir = os.path.join(tmp, "snapshot")
+        started = time.perf_counter()
+        main.save_inventory_snapshot(main.load_inventory(path), path, snapshot_dir)
+        print(f"Строк: {rows}, подготовка снимка: {time.perf_counter() - started:.2f} с")
+
+        loaders = (
+            ("CSV", lambda: main.load_inventory(path)),
+            ("снимка", lambda: main.load_inventory_snapshot(snapshot_dir)),
+        )
+        for title, load in loaders:
+            started = time.perf_counter()
+            inventory = load()
+            inventory.find_positions(rooms=2, city="Краснодар", price_max=6_000_000)
+            first_query = time.perf_counter() - started
+            print(f"Холодный старт из {title}: до первого запроса {first_query * 1000:.0f} мс")
+
+        started = time.perf_counter()
+        main.attach_snapshot_source(inventory, path)
+        print(f"Хэши строк для инкрементальной перезагрузки (в фоне): {(time.perf_counter() - started) * 1000:.0f} мс")
+
+
+# Локальные заглушки внешних сервисов для нагрузочного прогона
+@dataclass
+class FakeBehaviour:
+    """Поведение заглушки: средняя задержка ответа (с) и доля ответов с ошибкой."""
+    latency: float = 0.0
+    error_rate: float = 0.0
+
+    async def delay(self):
+        if self.latency:
+            await asyncio.sleep(self.latency * random.uniform(0.5, 1.5))
+
+    def fails(self):
+        return random.random() < self.error_rate
+
+
+def fake_telegram_routes(behaviour, calls):
+    """Bot API: getMe, sendMessage, editMessageText, sendChatAction и т.п. calls — счётчик вызовов по методам."""
+    message_ids = itertools.count(1)
+
+    async def handle(request):
+        method = request.match_info["method"]
+        if request.content_type == "application/json":
+            payload = await request.json()
+        else:
+            payload = dict(await request.post())
+        calls[method] = calls.get(method, 0) + 1
+        await behaviour.delay()
+        if method == "getMe":
+            return web.json_response({"ok": True, "result": {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}})
+        if behaviour.fails():
+            return web.json_response({"ok": False, "error_code": 502, "description": "Bad Gateway"}, status=502)
+        if method in ("sendMessage", "editMessageText"):
+            message_id = int(payload.get("message_id") or next(message_ids))
+            chat = {"id": int(payload["chat_id"]), "type": "private"}
+            result = {"message_id": message_id, "date": int(time.time()), "chat": chat, "text": payload.get("text", "")}
+            return web.json_response({"ok": True, "result": result})
+        return web.json_response({"ok": True, "result": True})
+
+    return [("POST", "/bot{token}/{method}", handle)]
+
+
+FAKE_POST = (
+    "🏡 **Квартиры с отделкой** в новом жилом комплексе!\n\n"
+    "Просторные планировки, закрытая территория и детские площадки. "
+    "Цены от застройщика, скидки при ипотеке. Звоните, покажем квартиру в удобное время!"
+)
+
+
+def fake_openai_routes(behaviour, chunk_interval=0.01):
+    """Chat Completions (в том числе stream=True) с шаблонным ответом."""
+    async def completions(request):
+        body = await request.json()
+        await behaviour.delay()
+        if behaviour.fails():
+            return web.json_response({"error": {"message": "The server is overloaded", "type": "server_error"}}, status=503)
+        prompt_tokens = sum(len(message["content"]) for message in body["messages"]) // 3
+        if not body.get("stream"):
+            return web.json_response({
+                "id": "bench", "object": "chat.completion", "model": body["model"],
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": FAKE_POST}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": len(FAKE_POST) // 3,
+                          "total_tokens": prompt_tokens + len(FAKE_POST) // 3},
+            })
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        words = FAKE_POST.split(" ")
+        for i, word in enumerate(words):
+            chunk = {"id": "bench", "object": "chat.completion.chunk", "model": body["model"],
+                     "choices": [{"index": 0, "delta": {"content": word if i == 0 else " " + word}, "finish_reason": None}]}
+            await response.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode())
+            await asyncio.sleep(chunk_interval)
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    return [("POST", "/v1/chat/completions", completions)]
+
+
+def fake_yandex_routes(behaviour, content, md5=None):
+    """Публичный ресурс Яндекс.Диска: метаданные, прямая ссылка и сам файл.
+
+    md5 подменяет контрольную сумму в метаданных; файл отдаётся с ETag и 304 на совпавший If-None-Match.
+    """
+    etag = f'"{hashlib.md5(content).hexdigest()}"'
+    if md5 is None:
+        md5 = hashlib.md5(content).hexdigest()
+
+    async def resource(request):
+        await behaviour.delay()
+        return web.json_response({"md5": md5, "modified": "2024-12-01T00:00:00+00:00", "size": len(content)})
+
+    async def download(request):
+        await behaviour.delay()
+        if behaviour.fails():
+            return web.json_response({"error": "DiskUnavailable"}, status=503)
+        return web.json_response({"href": f"{request.url.origin()}/yandex/file"})
+
+    async def file(request):
+        await behaviour.delay()
+        if request.headers.get("If-None-Match") == etag:
+            return web.Response(status=304, headers={"ETag": etag})
+        return web.Response(body=content, headers={"ETag": etag})
+
+    return [
+        ("GET", "/v1/disk/public/resources", resource),
+        ("GET", "/v1/disk/public/resources/download", download),
+        ("GET", "/yandex/file", file),
+    ]
+
+
+def make_update(update_id, chat_id, rnd):
+    text = (
+        f"Сделай пост про {rnd.choice(['1', '2', '3'])}-комнатные квартиры в {rnd.choice(COMPLEXES)} "
+        f"до {rnd.randint(4, 12)} млн"
+    )
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": "Bench"},
+            "text": text,
+        },
+    }
+
+
+def _rss_mb():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+
+
+async def _wait_idle(timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        sender = main.telegram_sender.stats()
+        if not main.update_dispatcher.size and not sender["queued"] and not sender["in_flight"]:
+            return True
+        await asyncio.sleep(0.05)
+    return False
+
+
+async def _bench_load(args):
+    # Шум логов искажает замеры: оставляем только предупреждения
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    rnd = random.Random(args.seed)
+    random.seed(args.seed)
+    rss_start = _rss_mb()
+    telegram_calls = {}
+    content = make_synthetic_frame(args.rows).to_csv(sep=";", index=False).encode()
+    fakes, base_url = await start_stub_server(
+        fake_telegram_routes(FakeBehaviour(args.telegram_latency, args.error_rate), telegram_calls)
+        + fake_openai_routes(FakeBehaviour(args.openai_latency, args.error_rate))
+        + fake_yandex_routes(FakeBehaviour(args.yandex_latency, args.error_rate), content)
+    )
+    with tempfile.TemporaryDirectory() as tmp:
+        main.DATA_FILE = os.path.join(tmp, "data.csv")
+        main.DATA_META_FILE = f"{main.DATA_FILE}.meta.json"
+        main.INVENTORY_SNAPSHOT_DIR = os.path.join(tmp, "snapshot")
+        main.YANDEX_API_URL = f"{base_url}/v1/disk"
+        main.YANDEX_FILE_URL = "https://disk.yandex.ru/d/bench"
+        main.YANDEX_DISK_TOKEN = "bench"
+        main.post_cache = main.PostCache(os.path.join(tmp, "post_cache.sqlite3"))
+        main.state_store = main.StateStore(os.path.join(tmp, "state.sqlite3"))
+        # Лимиты OpenAI сняты, чтобы мерить сам бот, а не токен-бакеты
+        main.generation_service = main.GenerationService(
+            concurrency=args.openai_concurrency, requests_per_minute=10**6, tokens_per_minute=10**9
+        )
+        openai.api_key = "bench"
+        openai.api_base = f"{base_url}/v1"
+        openai.aiosession.set(main.get_http_session())
+
+        started = time.perf_counter()
+        await main.refresh_data()
+        print(f"Загрузка прайса ({args.rows} строк) с заглушки Яндекс.Диска: {(time.perf_counter() - started) * 1000:.0f} мс")
+
+        main.application = main.build_application("123456:bench", base_url=f"{base_url}/bot")
+        await main.application.initialize()
+        await main.application.start()
+
+        sent_at = {}
+        end_to_end = []
+
+        async def process(update_data):
+            try:
+                await main.process_update_data(update_data)
+            finally:
+                end_to_end.append(time.perf_counter() - sent_at[update_data["update_id"]])
+
+        main.update_dispatcher = main.UpdateDispatcher(process, workers=args.workers)
+        main.update_dispatcher.start()
+        bot_runner = web.AppRunner(main.create_web_app(), access_log=None)
+        await bot_runner.setup()
+        site = web.TCPSite(bot_runner, "127.0.0.1", 0)
+        await site.start()
+        webhook_url = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}/webhook"
+
+        acks = []
+        statuses = {}
+
+        async def post(client, update):
+            sent_at[update["update_id"]] = started = time.perf_counter()
+            async with client.post(webhook_url, json=update) as response:
+                await response.read()
+            acks.append(time.perf_counter() - started)
+            statuses[response.status] = statuses.get(response.status, 0) + 1
+
+        total = int(args.rate * args.duration)
+        try:
+            async with ClientSession() as client:
+                tasks = []
+                replay_started = time.perf_counter()
+                # Открытая модель нагрузки: обновления приходят по расписанию, не дожидаясь ответов
+                for i in range(total):
+                    delay = replay_started + i / args.rate - time.perf_counter()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                    update = make_update(i + 1, 1000 + rnd.randrange(args.chats), rnd)
+                    tasks.append(asyncio.create_task(post(client, update)))
+                await asyncio.gather(*tasks)
+                replay_seconds = time.perf_counter() - replay_started
+                drained = await _wait_idle(args.drain_timeout)
+                elapsed = time.perf_counter() - replay_started
+        finally:
+            await main.update_dispatcher.stop()
+            await main.telegram_sender.stop()
+            await main.application.stop()
+            await main.application.shutdown()
+            await bot_runner.cleanup()
+            await main.close_http_session()
+            await fakes.cleanup()
+
+    processed = main.update_dispatcher.processed
+    print(f"Обновлений: {total} за {replay_seconds:.1f} с (цель {args.rate:g}/с), ответы вебхука: {statuses}")
+    print(f"Ответ вебхука: p50 {_percentile(acks, 50) * 1000:.1f} мс, p99 {_percentile(acks, 99) * 1000:.1f} мс")
+    if end_to_end:
+        print(
+            f"Обработка до конца (вебхук → пост отправлен): p50 {_percentile(end_to_end, 50) * 1000:.0f} мс, "
+            f"p99 {_percentile(end_to_end, 99) * 1000:.0f} мс"
+        )
+    print(
+        f"Пропускная способность: {processed / elapsed:.1f} обновлений/с, обработано {processed}, "
+        f"ошибок {main.update_dispatcher.failed}" + ("" if drained else " (очередь не разобрана к концу прогона)")
+    )
+    print(f"Очередь обновлений: {main.update_dispatcher.stats()}")
+    print(f"OpenAI: {main.generation_service.stats()}")
+    print(f"Исходящие сообщения: {main.telegram_sender.stats()}, вызовы Bot API: {telegram_calls}")
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"Память: RSS {rss_start:.0f} → {_rss_mb():.0f} МБ, пик {peak:.0f} МБ")
+
+
+def bench_load(args):
+    asyncio.run(_bench_load(args))
+
+
+SCENARIOS = {
+    "inventory": bench_inventory,
+    "reload": bench_reload,
+    "http": bench_http,
+    "startup": bench_startup,
+    "load": bench_load,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("scenario", choices=sorted(SCENARIOS))
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--requests", type=int, default=500)
+    load = parser.add_argument_group("load: нагрузочный прогон вебхуков с заглушками Telegram, OpenAI и Яндекс.Диска")
+    load.add_argument("--rate", type=float, default=20, help="обновлений в секунду")
+    load.add_argument("--duration", type=float, default=10, help="длительность подачи, с")
+    load.add_argument("--chats", type=int, default=200, help="число разных чатов")
+    load.add_argument("--telegram-latency", type=float, default=0.03)
+    load.add_argument("--openai-latency", type=float, default=0.5, help="задержка до первого фрагмента ответа, с")
+    load.add_argument("--yandex-latency", type=float, default=0.05)
+    load.add_argument("--error-rate", type=float, default=0.0, help="доля ответов заглушек с ошибкой")
+    load.add_argument("--openai-concurrency", type=int, default=16)
+    load.add_argument("--workers", type=int, default=main.UPDATE_WORKERS, help="обработчиков очереди обновлений")
+    load.add_argument("--drain-timeout", type=float, default=120, help="сколько ждать разбора очереди после подачи, с")
+    load.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    SCENARIOS[args.scenario](args)
@@ -1,12 +1,32 @@
 import os
+import sys
+import json
+import argparse
+import shutil
+import hashlib
+import tempfile
 import logging
+import numpy as np
 import pandas as pd
-from aiohttp import web, ClientSession
-from telegram import Update
+from aiohttp import web, ClientSession, ClientTimeout, TCPConnector
+from telegram import Bot, Update
+from telegram.constants import MessageLimit, ParseMode
+from telegram.error import BadRequest, NetworkError, RetryAfter
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
-from openai import ChatCompletion
+import openai
 import asyncio
+import bisect
+import html
+import io
+import random
 import re
+import sqlite3
+import threading
+import time
+from collections import deque
+from contextlib import aclosing, contextmanager
+from dataclasses import dataclass
+from functools import partial
 
 # Настройка логирования
 logging.basicConfig(
@@ -22,9 +42,101 @@ WEBHOOK_URL = os.getenv("WEBHOOK_URL")
 YANDEX_DISK_TOKEN = os.getenv("YANDEX_DISK_TOKEN")
 YANDEX_FILE_URL = os.getenv("YANDEX_FILE_URL")
 PORT = int(os.getenv("PORT", "8080"))
+YANDEX_API_URL = os.getenv("YANDEX_API_URL", "https://cloud-api.yandex.net/v1/disk").rstrip("/")
+DATA_FILE = os.getenv("DATA_FILE", "data.csv")
+DATA_META_FILE = f"{DATA_FILE}.meta.json"
+INVENTORY_SNAPSHOT_DIR = os.getenv("INVENTORY_SNAPSHOT_DIR", "inventory_snapshot")
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# Периодическое обновление прайса (секунды)
+REFRESH_INTERVAL = float(os.getenv("REFRESH_INTERVAL", "900"))
+REFRESH_JITTER = float(os.getenv("REFRESH_JITTER", "0.1"))
+REFRESH_BACKOFF_BASE = float(os.getenv("REFRESH_BACKOFF_BASE", "30"))
+REFRESH_BACKOFF_MAX = float(os.getenv("REFRESH_BACKOFF_MAX", "1800"))
+# POST /refresh доступен только с заголовком X-Refresh-Token; без токена маршрут всегда отвечает 403
+REFRESH_TOKEN = os.getenv("REFRESH_TOKEN")
+# Доступ к /metrics (Authorization: Bearer <токен>), без токена эндпоинт открыт
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+# Общий пул HTTP-соединений
+HTTP_POOL_LIMIT = int(os.getenv("HTTP_POOL_LIMIT", "100"))
+HTTP_POOL_LIMIT_PER_HOST = int(os.getenv("HTTP_POOL_LIMIT_PER_HOST", "20"))
+HTTP_DNS_CACHE_TTL = int(os.getenv("HTTP_DNS_CACHE_TTL", "300"))
+HTTP_KEEPALIVE_TIMEOUT = float(os.getenv("HTTP_KEEPALIVE_TIMEOUT", "60"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "10"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "60"))
+TELEGRAM_POOL_SIZE = int(os.getenv("TELEGRAM_POOL_SIZE", "32"))
+# Приём вебхуков
+WEBHOOK_SECRET_TOKEN = os.getenv("WEBHOOK_SECRET_TOKEN")
+WEBHOOK_MAX_BODY_SIZE = int(os.getenv("WEBHOOK_MAX_BODY_SIZE", str(1024 * 1024)))
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", "1000"))
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "8"))
+# Генерация постов через OpenAI
+OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4")
+OPENAI_MAX_TOKENS = int(os.getenv("OPENAI_MAX_TOKENS", "1500"))
+OPENAI_TEMPERATURE = float(os.getenv("OPENAI_TEMPERATURE", "1"))
+OPENAI_CONCURRENCY = int(os.getenv("OPENAI_CONCURRENCY", "4"))
+OPENAI_REQUESTS_PER_MINUTE = int(os.getenv("OPENAI_REQUESTS_PER_MINUTE", "60"))
+OPENAI_TOKENS_PER_MINUTE = int(os.getenv("OPENAI_TOKENS_PER_MINUTE", "40000"))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "3"))
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "120"))
+OPENAI_BACKOFF_BASE = float(os.getenv("OPENAI_BACKOFF_BASE", "2"))
+OPENAI_BACKOFF_MAX = float(os.getenv("OPENAI_BACKOFF_MAX", "60"))
+# Данные о квартирах в запросе к модели
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "2500"))
+PROMPT_MAX_ROWS = int(os.getenv("PROMPT_MAX_ROWS", "15"))
+PROMPT_COLUMNS = [
+    "Название ЖК", "Город", "Номер литера", "Количество комнат", "Общая площадь", "Номер этажа",
+    "Цена без скидок", "Цена со скидкой", "Старая цена", "Акция", "Дата обновления"
+]
+# Потоковая выдача постов правками сообщения
+STREAM_REPLIES = os.getenv("STREAM_REPLIES", "1") == "1"
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.0"))
+# Исходящие сообщения Telegram: лимиты Bot API (сообщений в секунду и интервал между сообщениями в чат)
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))
+TELEGRAM_CHAT_INTERVAL = float(os.getenv("TELEGRAM_CHAT_INTERVAL", "1.0"))
+TELEGRAM_GROUP_INTERVAL = float(os.getenv("TELEGRAM_GROUP_INTERVAL", "3.0"))
+TELEGRAM_SEND_CONCURRENCY = int(os.getenv("TELEGRAM_SEND_CONCURRENCY", "8"))
+TELEGRAM_SEND_RETRIES = int(os.getenv("TELEGRAM_SEND_RETRIES", "3"))
+# Пакетная генерация постов
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "3"))
+BATCH_OUTPUT_FILE = os.getenv("BATCH_OUTPUT_FILE", "batch_posts.jsonl")
+TELEGRAM_CHANNEL_ID = os.getenv("TELEGRAM_CHANNEL_ID")
+# Голосовые сообщения
+TRANSCRIBER = os.getenv("TRANSCRIBER", "openai")
+OPENAI_TRANSCRIBE_MODEL = os.getenv("OPENAI_TRANSCRIBE_MODEL", "whisper-1")
+VOICE_CONCURRENCY = int(os.getenv("VOICE_CONCURRENCY", "2"))
+VOICE_TIMEOUT = float(os.getenv("VOICE_TIMEOUT", "90"))
+VOICE_MAX_BYTES = int(os.getenv("VOICE_MAX_BYTES", str(20 * 1024 * 1024)))
+FFMPEG_BINARY = os.getenv("FFMPEG_BINARY", "ffmpeg")
+# Кэш сгенерированных постов
+POST_CACHE_PATH = os.getenv("POST_CACHE_PATH", "post_cache.sqlite3")
+POST_CACHE_TTL = float(os.getenv("POST_CACHE_TTL", str(24 * 3600)))
+POST_CACHE_MAX_ENTRIES = int(os.getenv("POST_CACHE_MAX_ENTRIES", "5000"))
+# Профили агентов (подписи, доступные команды, квоты)
+AGENTS_FILE = os.getenv("AGENTS_FILE", "agents.json")
+AGENTS_RELOAD_INTERVAL = float(os.getenv("AGENTS_RELOAD_INTERVAL", "5"))
+AGENT_USAGE_MAX_USERS = int(os.getenv("AGENT_USAGE_MAX_USERS", "10000"))
+# Постоянное состояние между перезапусками
+STATE_DB_PATH = os.getenv("STATE_DB_PATH", "state.sqlite3")
+STATE_MAX_ATTEMPTS = int(os.getenv("STATE_MAX_ATTEMPTS", "3"))
+STATE_MAX_AGE = float(os.getenv("STATE_MAX_AGE", str(6 * 3600)))
+SEEN_UPDATES_PRUNE_INTERVAL = 600
+CHAT_HISTORY_LIMIT = int(os.getenv("CHAT_HISTORY_LIMIT", "20"))
+CHAT_HISTORY_MAX_CHARS = int(os.getenv("CHAT_HISTORY_MAX_CHARS", "2000"))
+
+# Инициализация OpenAI (адрес API можно переопределить через OPENAI_API_BASE)
+openai.api_key = OPENAI_API_KEY
 
-# Инициализация OpenAI
-chat = ChatCompletion(api_key=OPENAI_API_KEY)
+# PROMPT для OpenAI
+PROMPT = (
+    "Этот GPT выступает в роли профессионального создателя контента для Телеграм-канала Ассоциации застройщиков. "
+    "Он создает максимально продающие посты на темы недвижимости, строительства, законодательства, инвестиций и связанных отраслей. "
+    "Контент ориентирован на привлечение внимания, удержание аудитории и стимулирование действий (например, обращения за консультацией или покупки). "
+    "Посты красиво оформляются с использованием эмодзи в стиле \"энергичный и современный\", добавляя динамичности и вовлеченности. "
+    "Например: 🏠 для темы недвижимости, 🚀 для роста, 📢 для новостей. "
+    "Все посты структурированные и содержат четкие призывы к действию, информацию о контактах и гиперссылки. "
+    "В конце каждого поста перед хэштегами указывается название компании \"Ассоциация застройщиков\", номер телефона 8-800-550-23-93. "
+    "В конце хэштеги на тему поста."
+)
 
 # Описание столбцов файла
 COLUMN_MAPPING = {
@@ -54,66 +166,2749 @@ IGNORE_COLUMNS = [
     "Картинка для анонса", "Доп фото", "Позиция в шахматке", "Жилой комплекс", "Путь до картинок"
 ]
 
+# Типы столбцов инвентаря (после переименования по COLUMN_MAPPING)
+INVENTORY_CATEGORY_COLUMNS = ["Название ЖК", "Город", "Литер"]
+INVENTORY_NUMERIC_COLUMNS = [
+    "Цена без скидок", "Цена со скидкой", "Цена за м2", "Цена за м2 со скидкой", "Общая площадь"
+]
+INVENTORY_FLAG_COLUMNS = ["Продано", "Бронь"]
+FLAG_TRUE_VALUES = {"1", "1.0", "да", "true", "yes", "y", "+", "продано", "бронь"}
+PRICE_BAND_STEP = 1_000_000
+# Ключ квартиры для инкрементальной перезагрузки прайса
+INVENTORY_KEY_COLUMNS = ["Название ЖК", "Литер", "Подъезд", "Номер квартиры"]
+# Если изменилась большая доля строк, дешевле перечитать файл целиком
+DELTA_RELOAD_MAX_SHARE = 0.5
+
 shutdown_event = asyncio.Event()
+inventory = None
+last_inventory_changes = None
+_refresh_task = None
+http_session = None
+update_dispatcher = None
+
+# Метрики в текстовом формате Prometheus (GET /metrics)
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+_metrics = []
+
+def _metric_labels(names, values, extra=""):
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _label_values(names, labels):
+    return tuple(str(labels[name]).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for name in names)
+
+class Counter:
+    """Монотонно растущий счётчик с метками."""
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = _label_values(self.labels, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_metric_labels(self.labels, key)} {value}")
+        return lines
+
+class Histogram:
+    """Распределение длительностей (секунды) по корзинам METRICS_BUCKETS. Можно вызывать из потоков."""
+
+    def __init__(self, name, documentation, labels=(), buckets=METRICS_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = buckets
+        self._values = {}  # метки -> [счётчики по корзинам, сумма, количество]
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def observe(self, value, **labels):
+        key = _label_values(self.labels, labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip((*self.buckets, "+Inf"), counts):
+                    cumulative += bucket_count
+                    labels = _metric_labels(self.labels, key, f'le="{bound}"')
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                lines.append(f"{self.name}_sum{_metric_labels(self.labels, key)} {total}")
+                lines.append(f"{self.name}_count{_metric_labels(self.labels, key)} {count}")
+        return lines
+
+webhook_seconds = Histogram("bot_webhook_seconds", "Время ответа на вебхук Telegram", ("status",))
+update_wait_seconds = Histogram("bot_update_queue_wait_seconds", "Ожидание обновления в очереди")
+update_process_seconds = Histogram("bot_update_process_seconds", "Обработка обновления", ("result",))
+yandex_download_seconds = Histogram("bot_yandex_download_seconds", "Проверка и загрузка прайса с Яндекс.Диска", ("result",))
+inventory_load_seconds = Histogram("bot_inventory_load_seconds", "Разбор прайса в инвентарь", ("mode",))
+inventory_query_seconds = Histogram("bot_inventory_query_seconds", "Выборка квартир по индексам")
+openai_request_seconds = Histogram("bot_openai_request_seconds", "Запрос к OpenAI", ("mode", "result"))
+openai_tokens = Counter("bot_openai_tokens_total", "Израсходовано токенов OpenAI", ("kind",))
+telegram_queue_seconds = Histogram("bot_telegram_queue_seconds", "Ожидание в очереди исходящих сообщений", ("priority",))
+telegram_send_seconds = Histogram("bot_telegram_send_seconds", "Вызов Bot API", ("result",))
+
+def _component_stats():
+    components = {
+        "update_queue": update_dispatcher.stats() if update_dispatcher is not None else {},
+        "openai": generation_service.stats(),
+        "post_cache": post_cache.stats(),
+        "voice": voice_pipeline.stats(),
+        "telegram_sender": telegram_sender.stats(),
+        "stream": stream_stats,
+        "agents": agent_registry.stats(),
+        "state": state_store.stats(),
+    }
+    if inventory is not None:
+        components["inventory"] = {"rows": len(inventory), "memory_bytes": inventory.memory_usage()}
+    return components
+
+def render_metrics():
+    """Все метрики в текстовом формате Prometheus. Сводки stats() компонентов выводятся как gauge."""
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    for component, stats in _component_stats().items():
+        for key, value in stats.items():
+            name = f"bot_{component}_{key}"
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {float(value)}")
+    return "\n".join(lines) + "\n"
+
+# Общая HTTP-сессия на всё время работы приложения
+def create_http_session():
+    connector = TCPConnector(
+        limit=HTTP_POOL_LIMIT,
+        limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+        ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+        keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+    )
+    timeout = ClientTimeout(total=None, connect=HTTP_CONNECT_TIMEOUT, sock_read=HTTP_READ_TIMEOUT)
+    return ClientSession(connector=connector, timeout=timeout)
+
+def get_http_session():
+    """Возвращает общую сессию с пулом соединений, создавая её при первом обращении."""
+    global http_session
+    if http_session is None or http_session.closed:
+        http_session = create_http_session()
+    return http_session
+
+async def close_http_session():
+    global http_session
+    if http_session is not None and not http_session.closed:
+        await http_session.close()
+    http_session = None
 
 # Загрузка данных с Яндекс.Диска
-async def download_yandex_file():
-    public_url = YANDEX_FILE_URL
+class YandexDiskError(Exception):
+    pass
+
+def _load_download_meta():
+    try:
+        with open(DATA_META_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _save_download_meta(meta):
+    tmp_path = f"{DATA_META_FILE}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False)
+    os.replace(tmp_path, DATA_META_FILE)
+
+def _open_temp_data_file():
+    directory = os.path.dirname(os.path.abspath(DATA_FILE))
+    fd, tmp_path = tempfile.mkstemp(prefix=".data-", suffix=".part", dir=directory)
+    return os.fdopen(fd, "wb"), tmp_path
+
+def _discard_temp_file(tmp_path):
+    try:
+        os.remove(tmp_path)
+    except OSError:
+        pass
+
+async def _fetch_resource_meta(session, headers):
+    # Метаданные ресурса (md5, дата изменения) без скачивания самого файла
+    try:
+        async with session.get(
+            f"{YANDEX_API_URL}/public/resources",
+            params={"public_key": YANDEX_FILE_URL, "fields": "md5,sha256,modified,size"},
+            headers=headers
+        ) as response:
+            if response.status == 200:
+                return await response.json()
+            logger.warning(f"Не удалось получить метаданные файла: {response.status}")
+    except Exception as e:
+        logger.warning(f"Ошибка при получении метаданных файла: {e}")
+    return {}
+
+async def _stream_to_data_file(response, expected_md5):
+    # Файл пишется частями во временный файл вне event loop и атомарно подменяет data.csv
+    f, tmp_path = await asyncio.to_thread(_open_temp_data_file)
+    digest = hashlib.md5()
+    try:
+        async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+            digest.update(chunk)
+            await asyncio.to_thread(f.write, chunk)
+        await asyncio.to_thread(f.close)
+        md5 = digest.hexdigest()
+        if expected_md5 and md5 != expected_md5:
+            raise ValueError(f"md5 не совпадает: ожидался {expected_md5}, получен {md5}")
+        await asyncio.to_thread(os.replace, tmp_path, DATA_FILE)
+        return md5
+    except BaseException:
+        f.close()
+        await asyncio.to_thread(_discard_temp_file, tmp_path)
+        raise
+
+async def fetch_yandex_file():
+    """Скачивает файл с Яндекс.Диска, если он изменился. Возвращает True, если data.csv обновлён.
+
+    В отличие от download_yandex_file, ошибки не перехватываются.
+    """
     headers = {
         'Authorization': f'OAuth {YANDEX_DISK_TOKEN}'
     }
+    saved_meta = await asyncio.to_thread(_load_download_meta)
+    data_exists = os.path.exists(DATA_FILE)
+    session = get_http_session()
+    resource_meta = await _fetch_resource_meta(session, headers)
+    remote_md5 = resource_meta.get("md5")
+    if data_exists and remote_md5 and remote_md5 == saved_meta.get("md5"):
+        logger.info("Файл на Яндекс.Диске не изменился, загрузка пропущена.")
+        return False
+
+    async with session.get(
+        f"{YANDEX_API_URL}/public/resources/download",
+        params={"public_key": YANDEX_FILE_URL},
+        headers=headers
+    ) as response:
+        if response.status != 200:
+            raise YandexDiskError(f"Ошибка получения прямой ссылки: {response.status}")
+        data = await response.json()
+    direct_link = data.get("href")
+    if not direct_link:
+        raise YandexDiskError("Яндекс.Диск не вернул прямую ссылку на файл.")
+
+    # Условный запрос: при совпадении ETag/Last-Modified сервер вернёт 304
+    conditional_headers = {}
+    if data_exists:
+        if saved_meta.get("etag"):
+            conditional_headers["If-None-Match"] = saved_meta["etag"]
+        if saved_meta.get("last_modified"):
+            conditional_headers["If-Modified-Since"] = saved_meta["last_modified"]
+
+    async with session.get(direct_link, headers=conditional_headers) as file_response:
+        if file_response.status == 304:
+            logger.info("Файл не изменился (304), загрузка пропущена.")
+            return False
+        if file_response.status != 200:
+            raise YandexDiskError(f"Ошибка загрузки файла: {file_response.status}")
+        md5 = await _stream_to_data_file(file_response, remote_md5)
+        await asyncio.to_thread(_save_download_meta, {
+            "etag": file_response.headers.get("ETag"),
+            "last_modified": file_response.headers.get("Last-Modified"),
+            "md5": md5,
+            "modified": resource_meta.get("modified"),
+        })
+    logger.info("Файл успешно загружен с Яндекс.Диска.")
+    return True
+
+async def download_yandex_file():
+    """Скачивает файл с Яндекс.Диска, если он изменился. Возвращает True, если data.csv обновлён."""
     try:
-        async with ClientSession() as session:
-            async with session.get(
-                f"https://cloud-api.yandex.net/v1/disk/public/resources/download?public_key={public_url}",
-                headers=headers
-            ) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    direct_link = data.get("href")
-                    if direct_link:
-                        async with session.get(direct_link) as file_response:
-                            if file_response.status == 200:
-                                content = await file_response.text()
-                                with open("data.csv", "w", encoding="utf-8") as f:
-                                    f.write(content)
-                                logger.info("Файл успешно загружен с Яндекс.Диска.")
-                            else:
-                                logger.error(f"Ошибка загрузки файла: {file_response.status}")
-                else:
-                    logger.error(f"Ошибка получения прямой ссылки: {response.status}")
+        return await fetch_yandex_file()
     except Exception as e:
         logger.error(f"Ошибка при загрузке файла: {e}")
+        return False
+
+# Инвентарь квартир: загрузка data.csv в память и индексы для быстрых выборок
+def _normalize_key(value):
+    # "ё" и "е" в названиях ЖК и городов пишут вперемешку
+    return str(value).strip().casefold().replace("ё", "е")
+
+def _detect_csv_format(path):
+    for encoding in ("utf-8-sig", "cp1251"):
+        try:
+            with open(path, "r", encoding=encoding) as f:
+                header = f.readline()
+            break
+        except UnicodeDecodeError:
+            continue
+    sep = ";" if header.count(";") > header.count(",") else ","
+    return sep, encoding
+
+def _to_number(series):
+    if series.dtype == object or pd.api.types.is_string_dtype(series):
+        series = (
+            series.astype(str)
+            .str.replace(r"[\s\u00a0]", "", regex=True)
+            .str.replace(",", ".", regex=False)
+        )
+    return pd.to_numeric(series, errors="coerce")
+
+def _to_flag(series):
+    if pd.api.types.is_numeric_dtype(series):
+        return series.fillna(0).astype(bool)
+    return series.astype(str).str.strip().str.casefold().isin(FLAG_TRUE_VALUES)
+
+def _to_rooms(series):
+    rooms = _to_number(series)
+    if not pd.api.types.is_numeric_dtype(series):
+        # Студии считаются нулекомнатными
+        rooms = rooms.mask(series.astype(str).str.casefold().str.contains("студ", na=False), 0)
+    return rooms.fillna(-1).astype(np.int8)
+
+def prepare_inventory_frame(df):
+    """Приводит сырую таблицу к рабочему виду: убирает лишние столбцы, переименовывает и сжимает типы."""
+    df = df.drop(columns=[c for c in IGNORE_COLUMNS if c in df.columns])
+    df = df.rename(columns=COLUMN_MAPPING)
+    df = df.loc[:, ~df.columns.duplicated()]
+    for column in INVENTORY_CATEGORY_COLUMNS:
+        if column in df.columns:
+            df[column] = df[column].astype("category")
+    for column in INVENTORY_NUMERIC_COLUMNS:
+        if column in df.columns:
+            df[column] = _to_number(df[column]).astype(np.float64)
+    if "Общая площадь" in df.columns:
+        df["Общая площадь"] = df["Общая площадь"].astype(np.float32)
+    if "Количество комнат" in df.columns:
+        df["Количество комнат"] = _to_rooms(df["Количество комнат"])
+    for column in INVENTORY_FLAG_COLUMNS:
+        if column in df.columns:
+            df[column] = _to_flag(df[column])
+    for column in df.columns:
+        series = df[column]
+        if pd.api.types.is_integer_dtype(series) and not pd.api.types.is_bool_dtype(series):
+            df[column] = pd.to_numeric(series, downcast="integer")
+        elif series.dtype == object or pd.api.types.is_string_dtype(series):
+            # Повторяющиеся строки (акции, тип договора, даты) хранятся как категории
+            if series.nunique(dropna=False) <= len(series) // 2:
+                df[column] = series.astype("category")
+    return df.reset_index(drop=True)
+
+class _ColumnIndex:
+    """Вторичный индекс по столбцу: ключ -> отсортированные позиции строк и номер ключа для каждой строки."""
+
+    def __init__(self, series, normalize):
+        self.normalize = normalize
+        self.positions = {}
+        if series is None:
+            self.codes = np.empty(0, dtype=np.int32)
+            self.key_codes = {}
+            return
+        for value, positions in series.groupby(series, observed=True, sort=False).indices.items():
+            key = normalize(value)
+            positions = np.asarray(positions, dtype=np.int32)
+            self.positions[key] = np.union1d(self.positions[key], positions) if key in self.positions else positions
+        self.codes = np.full(len(series), -1, dtype=np.int32)
+        self.key_codes = {}
+        for code, (key, positions) in enumerate(self.positions.items()):
+            self.codes[positions] = code
+            self.key_codes[key] = code
+
+    def lookup(self, value):
+        key = self.normalize(value)
+        return self.key_codes.get(key), self.positions.get(key)
+
+    def nbytes(self):
+        return self.codes.nbytes + sum(positions.nbytes for positions in self.positions.values())
+
+class Inventory:
+    """Таблица квартир в памяти с вторичными индексами по ЖК, городу, комнатности и ценовому диапазону."""
+
+    def __init__(self, df):
+        self.df = df
+        size = len(df)
+        self.prices = self._effective_prices(df)
+        sold = df["Продано"].to_numpy(dtype=bool) if "Продано" in df.columns else np.zeros(size, dtype=bool)
+        booked = df["Бронь"].to_numpy(dtype=bool) if "Бронь" in df.columns else np.zeros(size, dtype=bool)
+        self.available = ~(sold | booked)
+        self.by_complex = _ColumnIndex(df.get("Название ЖК"), _normalize_key)
+        self.by_city = _ColumnIndex(df.get("Город"), _normalize_key)
+        self.by_rooms = _ColumnIndex(df.get("Количество комнат"), int)
+        bands = np.where(np.isnan(self.prices), -1, self.prices // PRICE_BAND_STEP).astype(np.int64)
+        self.by_price_band = _ColumnIndex(pd.Series(bands), int)
+        self.by_price_band.positions.pop(-1, None)
+        self.source_header = None
+        self.source_md5 = None
+        self.line_digests = None
+        self._versions = {}
+
+    def __len__(self):
+        return len(self.df)
+
+    @staticmethod
+    def _effective_prices(df):
+        # Цена со скидкой, если она указана, иначе базовая цена
+        prices = np.full(len(df), np.nan)
+        if "Цена без скидок" in df.columns:
+            prices = df["Цена без скидок"].to_numpy(dtype=np.float64, na_value=np.nan)
+        if "Цена со скидкой" in df.columns:
+            discounted = df["Цена со скидкой"].to_numpy(dtype=np.float64, na_value=np.nan)
+            prices = np.where(discounted > 0, discounted, prices)
+        return prices
+
+    def _price_band_positions(self, price_min, price_max):
+        low = int(price_min // PRICE_BAND_STEP) if price_min is not None else None
+        high = int(price_max // PRICE_BAND_STEP) if price_max is not None else None
+        chunks = [
+            positions for band, positions in self.by_price_band.positions.items()
+            if (low is None or band >= low) and (high is None or band <= high)
+        ]
+        if not chunks:
+            return np.empty(0, dtype=np.int32)
+        return np.sort(np.concatenate(chunks))
+
+    def find_positions(self, complex_name=None, city=None, rooms=None,
+                       price_min=None, price_max=None, only_available=True, limit=None):
+        """Возвращает позиции строк, подходящих под все заданные условия."""
+        with inventory_query_seconds.time():
+            return self._find_positions(complex_name, city, rooms, price_min, price_max, only_available, limit)
+
+    def _find_positions(self, complex_name, city, rooms, price_min, price_max, only_available, limit):
+        matches = []
+        lookups = ((self.by_complex, complex_name), (self.by_city, city), (self.by_rooms, rooms))
+        for index, value in lookups:
+            if value is None:
+                continue
+            code, positions = index.lookup(value)
+            if positions is None:
+                return np.empty(0, dtype=np.int32)
+            matches.append((index, code, positions))
+
+        if matches:
+            # Начинаем с самого короткого списка позиций, остальные условия проверяем по номерам ключей
+            matches.sort(key=lambda match: len(match[2]))
+            candidates = matches[0][2]
+        elif price_min is not None or price_max is not None:
+            candidates = self._price_band_positions(price_min, price_max)
+        else:
+            candidates = np.arange(len(self.df), dtype=np.int32)
+
+        mask = np.ones(len(candidates), dtype=bool)
+        for index, code, _ in matches[1:]:
+            mask &= index.codes[candidates] == code
+        if only_available:
+            mask &= self.available[candidates]
+        if price_min is not None:
+            mask &= self.prices[candidates] >= price_min
+        if price_max is not None:
+            mask &= self.prices[candidates] <= price_max
+        candidates = candidates[mask]
+        if limit is not None:
+            candidates = candidates[:limit]
+        return candidates
+
+    def attach_source(self, header, rows, digests=None):
+        """Запоминает заголовок и хэши строк исходного файла для последующей инкрементальной перезагрузки."""
+        if digests is None:
+            digests = _line_digests(rows)
+        self.source_header = header
+        self.line_digests = digests if len(digests) == len(self.df) else None
+
+    def find(self, **filters):
+        """Выборка квартир в виде DataFrame, например find(rooms=2, city="Краснодар", price_max=6_000_000)."""
+        return self.df.iloc[self.find_positions(**filters)]
+
+    def mentioned_complexes(self, text):
+        """Названия ЖК (в нормализованном виде), упомянутые в тексте запроса."""
+        text = _normalize_key(text)
+        return sorted(
+            key for key in self.by_complex.positions
+            if key and key in text and re.search(rf"(?<!\w){re.escape(key)}(?!\w)", text)
+        )
+
+    def snapshot_version(self, complexes=None):
+        """Устойчивый между перезапусками хэш данных выбранных ЖК (или всей таблицы)."""
+        cache_key = tuple(complexes) if complexes else None
+        if cache_key not in self._versions:
+            if complexes:
+                positions = np.concatenate([self.by_complex.positions[key] for key in complexes])
+                rows = self.df.iloc[np.sort(positions)]
+            else:
+                rows = self.df
+            hashes = pd.util.hash_pandas_object(rows, index=False).to_numpy()
+            self._versions[cache_key] = hashlib.sha256(hashes.tobytes()).hexdigest()[:16]
+        return self._versions[cache_key]
+
+    def memory_usage(self):
+        """Оценка занимаемой памяти в байтах (таблица и индексы)."""
+        total = int(self.df.memory_usage(deep=True).sum()) + self.prices.nbytes + self.available.nbytes
+        for index in (self.by_complex, self.by_city, self.by_rooms, self.by_price_band):
+            total += index.nbytes()
+        return total
+
+def _read_inventory_source(path):
+    sep, encoding = _detect_csv_format(path)
+    with open(path, "r", encoding=encoding, newline="") as f:
+        lines = f.read().split("\n")
+    header = lines[0].rstrip("\r")
+    rows = [line.rstrip("\r") for line in lines[1:]]
+    return sep, header, [row for row in rows if row]
+
+def _line_digests(rows):
+    return np.fromiter((hash(row) for row in rows), dtype=np.int64, count=len(rows))
+
+def _digests_present(values, reference):
+    # Проверка вхождения через бинарный поиск по отсортированной копии, быстрее np.isin на таких объёмах
+    if not len(reference):
+        return np.zeros(len(values), dtype=bool)
+    reference = np.sort(reference)
+    positions = np.minimum(np.searchsorted(reference, values), len(reference) - 1)
+    return reference[positions] == values
+
+def _parse_inventory_rows(sep, header, rows):
+    category_sources = [raw for raw, name in COLUMN_MAPPING.items() if name in INVENTORY_CATEGORY_COLUMNS]
+    df = pd.read_csv(
+        io.StringIO("\n".join([header, *rows])),
+        sep=sep,
+        usecols=lambda column: column not in IGNORE_COLUMNS,
+        dtype={column: "category" for column in category_sources},
+        low_memory=False,
+    )
+    return prepare_inventory_frame(df)
+
+def load_inventory(path=None):
+    """Читает data.csv и строит Inventory. Синхронная функция, вызывать через asyncio.to_thread."""
+    sep, header, rows = _read_inventory_source(path or DATA_FILE)
+    result = Inventory(_parse_inventory_rows(sep, header, rows))
+    result.attach_source(header, rows)
+    return result
+
+def _key_part(value):
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value).strip()
+
+def _row_keys(df):
+    columns = [column for column in INVENTORY_KEY_COLUMNS if column in df.columns]
+    if not columns:
+        return [None] * len(df)
+    return [
+        tuple(_key_part(value) for value in values)
+        for values in zip(*(df[column].astype(object) for column in columns))
+    ]
+
+def _is_filled(series):
+    return series.astype("string").fillna("").str.strip().ne("").to_numpy(dtype=bool)
+
+def _concat_inventory_frames(base, extra):
+    # Приводит типы добавляемых строк к типам основной таблицы, объединяя категории
+    if extra.empty:
+        return base.reset_index(drop=True)
+    base = base.copy()
+    extra = extra.copy()
+    for column in base.columns.intersection(extra.columns):
+        base_is_category = isinstance(base[column].dtype, pd.CategoricalDtype)
+        if base_is_category:
+            values = extra[column].astype(object)
+            missing = pd.Index(values.dropna().unique()).difference(base[column].cat.categories)
+            if len(missing):
+                base[column] = base[column].cat.add_categories(missing)
+            extra[column] = pd.Categorical(values, categories=base[column].cat.categories)
+        elif isinstance(extra[column].dtype, pd.CategoricalDtype):
+            extra[column] = extra[column].astype(object)
+    return pd.concat([base, extra], ignore_index=True)
+
+@dataclass
+class InventoryChanges:
+    """Изменения прайса между двумя загрузками. updated и previous выровнены построчно."""
+    inserted: pd.DataFrame
+    updated: pd.DataFrame
+    previous: pd.DataFrame
+    deleted: pd.DataFrame
+
+    def __bool__(self):
+        return bool(len(self.inserted) or len(self.updated) or len(self.deleted))
+
+    @property
+    def price_drops(self):
+        new_prices = Inventory._effective_prices(self.updated)
+        old_prices = Inventory._effective_prices(self.previous)
+        drops = self.updated[new_prices < old_prices].copy()
+        drops["Старая цена"] = old_prices[new_prices < old_prices]
+        return drops
+
+    @property
+    def newly_sold(self):
+        if "Продано" not in self.updated.columns:
+            return self.updated.iloc[0:0]
+        was_sold = self.previous["Продано"].to_numpy(dtype=bool)
+        return self.updated[self.updated["Продано"].to_numpy(dtype=bool) & ~was_sold]
+
+    @property
+    def new_promotions(self):
+        if "Акция" not in self.updated.columns:
+            return self.inserted.iloc[0:0]
+        new_promo = self.updated["Акция"].astype("string").fillna("").str.strip().to_numpy()
+        old_promo = self.previous["Акция"].astype("string").fillna("").str.strip().to_numpy()
+        updated = self.updated[(new_promo != "") & (new_promo != old_promo)]
+        inserted = self.inserted[_is_filled(self.inserted["Акция"])]
+        return pd.concat([updated, inserted])
+
+    def complexes(self):
+        """Нормализованные названия ЖК, затронутых изменениями."""
+        names = set()
+        for frame in (self.inserted, self.updated, self.deleted):
+            if "Название ЖК" in frame.columns:
+                names.update(_normalize_key(name) for name in frame["Название ЖК"].dropna().unique())
+        return names
+
+    def summary(self):
+        return (
+            f"новых: {len(self.inserted)}, изменено: {len(self.updated)}, удалено: {len(self.deleted)}, "
+            f"снижений цены: {len(self.price_drops)}, продано: {len(self.newly_sold)}, "
+            f"новых акций: {len(self.new_promotions)}"
+        )
+
+def load_inventory_delta(previous, path=None):
+    """Перечитывает data.csv, разбирая только изменившиеся строки. Возвращает (Inventory, InventoryChanges или None)."""
+    sep, header, rows = _read_inventory_source(path or DATA_FILE)
+    digests = _line_digests(rows)
+    if previous is None or previous.line_digests is None or header != previous.source_header:
+        result = Inventory(_parse_inventory_rows(sep, header, rows))
+        result.attach_source(header, rows, digests)
+        return result, None
+
+    # Строки, совпадающие байт в байт, не разбираются заново
+    kept = _digests_present(previous.line_digests, digests)
+    fresh = ~_digests_present(digests, previous.line_digests)
+    fresh_positions = np.flatnonzero(fresh)
+    if len(fresh_positions) > len(rows) * DELTA_RELOAD_MAX_SHARE:
+        result = Inventory(_parse_inventory_rows(sep, header, rows))
+        result.attach_source(header, rows, digests)
+        return result, None
+
+    if len(fresh_positions):
+        changed = _parse_inventory_rows(sep, header, [rows[i] for i in fresh_positions])
+    else:
+        changed = previous.df.iloc[0:0]
+    removed = previous.df.iloc[np.flatnonzero(~kept)]
+
+    removed_by_key = {key: i for i, key in enumerate(_row_keys(removed)) if key is not None}
+    updated_positions, previous_positions, inserted_positions = [], [], []
+    for i, key in enumerate(_row_keys(changed)):
+        old = removed_by_key.pop(key, None) if key is not None else None
+        if old is None:
+            inserted_positions.append(i)
+        else:
+            updated_positions.append(i)
+            previous_positions.append(old)
+    changes = InventoryChanges(
+        inserted=changed.iloc[inserted_positions],
+        updated=changed.iloc[updated_positions],
+        previous=removed.iloc[previous_positions],
+        deleted=removed.iloc[sorted(removed_by_key.values())],
+    )
+
+    # Строки новой таблицы идут в порядке файла: неизменённые берутся из старой таблицы, новые из разобранных
+    old_order = np.argsort(previous.line_digests, kind="stable")
+    old_positions = old_order[np.searchsorted(previous.line_digests[old_order], digests[~fresh])]
+    take = np.empty(len(rows), dtype=np.int64)
+    take[~fresh] = old_positions
+    take[fresh] = len(previous.df) + np.arange(len(fresh_positions))
+    combined = _concat_inventory_frames(previous.df, changed)
+    result = Inventory(combined.iloc[take].reset_index(drop=True))
+    result.attach_source(header, rows, digests)
+    return result, changes
+
+# Снимок инвентаря: столбцы в формате .npy для быстрого холодного старта
+def _file_md5(path):
+    digest = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def save_inventory_snapshot(source, data_path=None, directory=None):
+    """Сохраняет таблицу инвентаря постолбцово. Новая версия становится текущей атомарной заменой указателя."""
+    directory = directory or INVENTORY_SNAPSHOT_DIR
+    data_path = data_path or DATA_FILE
+    os.makedirs(directory, exist_ok=True)
+    version = f"v{time.time_ns()}"
+    version_dir = os.path.join(directory, version)
+    os.makedirs(version_dir)
+    columns = []
+    for i, (name, series) in enumerate(source.df.items()):
+        file_name = f"{i}.npy"
+        if isinstance(series.dtype, pd.CategoricalDtype) or not (
+            pd.api.types.is_numeric_dtype(series) or pd.api.types.is_bool_dtype(series)
+        ):
+            series = series.astype("category")
+            np.save(os.path.join(version_dir, file_name), series.cat.codes.to_numpy())
+            columns.append({"name": name, "file": file_name, "categories": series.cat.categories.tolist()})
+        else:
+            np.save(os.path.join(version_dir, file_name), series.to_numpy())
+            columns.append({"name": name, "file": file_name})
+    meta = {
+        "rows": len(source.df),
+        "columns": columns,
+        "source_md5": _file_md5(data_path) if os.path.exists(data_path) else None,
+        "source_header": source.source_header,
+        "created": time.time(),
+    }
+    with open(os.path.join(version_dir, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False)
+    source.source_md5 = meta["source_md5"]
+
+    pointer = os.path.join(directory, "CURRENT")
+    with open(f"{pointer}.tmp", "w", encoding="utf-8") as f:
+        f.write(version)
+    os.replace(f"{pointer}.tmp", pointer)
+    for entry in os.listdir(directory):
+        if entry.startswith("v") and entry != version:
+            shutil.rmtree(os.path.join(directory, entry), ignore_errors=True)
+    return version_dir
+
+def load_inventory_snapshot(directory=None):
+    """Поднимает последний снимок инвентаря (столбцы отображаются в память). Возвращает None, если снимка нет."""
+    directory = directory or INVENTORY_SNAPSHOT_DIR
+    try:
+        with open(os.path.join(directory, "CURRENT"), "r", encoding="utf-8") as f:
+            version_dir = os.path.join(directory, f.read().strip())
+        with open(os.path.join(version_dir, "meta.json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    data = {}
+    for column in meta["columns"]:
+        values = np.load(os.path.join(version_dir, column["file"]), mmap_mode="r")
+        if "categories" in column:
+            data[column["name"]] = pd.Categorical.from_codes(values, column["categories"])
+        else:
+            data[column["name"]] = values
+    df = pd.DataFrame(data, copy=False)
+    if len(df) != meta["rows"]:
+        raise ValueError(f"Снимок повреждён: {len(df)} строк вместо {meta['rows']}")
+    result = Inventory(df)
+    result.source_header = meta.get("source_header")
+    result.source_md5 = meta.get("source_md5")
+    return result
+
+def attach_snapshot_source(source, data_path=None):
+    """Считает хэши строк data.csv для инкрементальной перезагрузки, если файл совпадает со снимком."""
+    data_path = data_path or DATA_FILE
+    if not source.source_md5 or not os.path.exists(data_path) or _file_md5(data_path) != source.source_md5:
+        return False
+    _, header, rows = _read_inventory_source(data_path)
+    source.attach_source(header, rows)
+    return source.line_digests is not None
+
+async def restore_inventory():
+    """При старте поднимает последний снимок инвентаря, а если его нет — data.csv."""
+    global inventory
+    try:
+        with inventory_load_seconds.time(mode="snapshot"):
+            restored = await asyncio.to_thread(load_inventory_snapshot)
+    except Exception as e:
+        logger.warning(f"Не удалось загрузить снимок инвентаря: {e}")
+        restored = None
+    if restored is None:
+        if os.path.exists(DATA_FILE):
+            await reload_inventory()
+        return
+    inventory = restored
+    logger.info(f"Инвентарь поднят из снимка: {len(inventory)} квартир.")
+    try:
+        await asyncio.to_thread(attach_snapshot_source, restored)
+    except Exception as e:
+        logger.warning(f"Не удалось сопоставить снимок с {DATA_FILE}: {e}")
+
+async def _save_snapshot(source):
+    try:
+        await asyncio.to_thread(save_inventory_snapshot, source)
+    except Exception as e:
+        logger.error(f"Ошибка сохранения снимка инвентаря: {e}")
+
+async def reload_inventory():
+    """Обновляет инвентарь из data.csv. Возвращает изменения относительно предыдущей загрузки (или None)."""
+    global inventory, last_inventory_changes
+    if not os.path.exists(DATA_FILE):
+        logger.warning(f"Файл {DATA_FILE} не найден, инвентарь не загружен.")
+        return None
+    started = time.perf_counter()
+    try:
+        inventory, changes = await asyncio.to_thread(load_inventory_delta, inventory, DATA_FILE)
+    except Exception as e:
+        inventory_load_seconds.observe(time.perf_counter() - started, mode="error")
+        logger.error(f"Ошибка при загрузке инвентаря: {e}", exc_info=True)
+        return None
+    inventory_load_seconds.observe(time.perf_counter() - started, mode="full" if changes is None else "delta")
+    last_inventory_changes = changes
+    if changes:
+        await post_cache.invalidate(changes.complexes())
+    if changes is None or changes:
+        await _save_snapshot(inventory)
+    if changes is None:
+        logger.info(f"Инвентарь загружен: {len(inventory)} квартир.")
+    else:
+        logger.info(f"Инвентарь обновлён: {len(inventory)} квартир; {changes.summary()}")
+    return changes
+
+# Фоновое обновление данных
+async def _refresh_data():
+    started = time.perf_counter()
+    try:
+        changed = await fetch_yandex_file()
+    except Exception:
+        yandex_download_seconds.observe(time.perf_counter() - started, result="error")
+        raise
+    yandex_download_seconds.observe(time.perf_counter() - started, result="updated" if changed else "unchanged")
+    # Снимок, не совпавший с data.csv, тоже перечитываем
+    if changed or inventory is None or inventory.line_digests is None:
+        return await reload_inventory()
+    return None
+
+async def refresh_data():
+    """Скачивает файл и обновляет инвентарь. Параллельные вызовы дожидаются одного и того же обновления."""
+    global _refresh_task
+    if _refresh_task is None or _refresh_task.done():
+        _refresh_task = asyncio.create_task(_refresh_data())
+    return await asyncio.shield(_refresh_task)
+
+def _next_refresh_delay(failures):
+    if failures:
+        delay = min(REFRESH_BACKOFF_MAX, REFRESH_BACKOFF_BASE * 2 ** (failures - 1))
+    else:
+        delay = REFRESH_INTERVAL
+    return delay * (1 + random.uniform(-REFRESH_JITTER, REFRESH_JITTER))
+
+async def refresh_scheduler():
+    failures = 0
+    while not shutdown_event.is_set():
+        try:
+            await refresh_data()
+            failures = 0
+        except Exception as e:
+            failures += 1
+            logger.error(f"Ошибка обновления данных (попытка {failures}): {e}")
+        delay = _next_refresh_delay(failures)
+        try:
+            await asyncio.wait_for(shutdown_event.wait(), timeout=delay)
+        except asyncio.TimeoutError:
+            pass
+
+def _describe_refresh(changes):
+    if changes is None:
+        return f"Данные актуальны, квартир в базе: {len(inventory) if inventory is not None else 0}."
+    return f"Данные обновлены: {changes.summary()}."
+
+async def refresh_handler(request):
+    # Без настроенного токена обновление извне запрещено
+    if not REFRESH_TOKEN or request.headers.get("X-Refresh-Token") != REFRESH_TOKEN:
+        return web.Response(status=403)
+    try:
+        changes = await refresh_data()
+    except Exception as e:
+        logger.error(f"Ошибка обновления данных по запросу: {e}")
+        return web.json_response({"status": "error", "error": str(e)}, status=502)
+    return web.json_response({"status": "ok", "message": _describe_refresh(changes)})
+
+async def refresh_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if await authorize(update, "refresh") is None:
+        return
+    await reply_text(update, "Обновляю данные с Яндекс.Диска...")
+    try:
+        changes = await refresh_data()
+    except Exception as e:
+        logger.error(f"Ошибка обновления данных по команде: {e}")
+        await reply_text(update, "Не удалось обновить данные, попробуйте позже.")
+        return
+    await reply_text(update, _describe_refresh(changes))
 
 # Добавление корневого маршрута для проверки
 async def root_handler(request):
     return web.Response(text="Сервер работает!")
 
-# Вебхуковый маршрут
+# Генерация текстов через OpenAI
+OPENAI_RETRY_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.ServiceUnavailableError,
+    openai.error.APIError,
+    openai.error.APIConnectionError,
+    openai.error.Timeout,
+    openai.error.TryAgain,
+)
+
+def estimate_tokens(text):
+    # Грубая оценка: для русского текста около трёх символов на токен
+    return len(text) // 3 + 1
+
+class TokenBucket:
+    """Ограничитель скорости: не больше rate_per_minute единиц в минуту, запросы обслуживаются по очереди."""
+
+    def __init__(self, rate_per_minute):
+        self.capacity = float(rate_per_minute)
+        self.rate = self.capacity / 60
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, amount=1):
+        amount = min(amount, self.capacity)
+        async with self._lock:
+            self._refill()
+            while self.tokens < amount:
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= amount
+
+    def adjust(self, amount):
+        """Возвращает неиспользованный резерв (amount > 0) или списывает перерасход (amount < 0)."""
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+def _openai_retry_delay(error, attempt):
+    headers = getattr(error, "headers", None) or {}
+    retry_after = headers.get("retry-after") or headers.get("Retry-After")
+    if retry_after:
+        try:
+            return min(OPENAI_BACKOFF_MAX, float(retry_after))
+        except ValueError:
+            pass
+    delay = min(OPENAI_BACKOFF_MAX, OPENAI_BACKOFF_BASE * 2 ** attempt)
+    return delay * random.uniform(0.5, 1)
+
+class _SharedStream:
+    """Один поток ответа OpenAI на всех одновременных потребителей. Подключившийся позже получает текст с начала."""
+
+    def __init__(self, fragments):
+        self.fragments = []
+        self.consumers = 0
+        self._changed = asyncio.Event()
+        self.task = asyncio.create_task(self._pump(fragments))
+
+    async def _pump(self, fragments):
+        try:
+            async for fragment in fragments:
+                self.fragments.append(fragment)
+                self._notify()
+        finally:
+            self._notify()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def follow(self):
+        self.consumers += 1
+        position = 0
+        try:
+            while True:
+                while position < len(self.fragments):
+                    position += 1
+                    yield self.fragments[position - 1]
+                if self.task.done():
+                    if not self.task.cancelled() and self.task.exception() is not None:
+                        raise self.task.exception()
+                    return
+                await self._changed.wait()
+        finally:
+            self.consumers -= 1
+
+class GenerationService:
+    """Обращения к OpenAI с ограничением параллельности и скорости, повторами и объединением одинаковых запросов."""
+
+    def __init__(self, concurrency=OPENAI_CONCURRENCY, requests_per_minute=OPENAI_REQUESTS_PER_MINUTE,
+                 tokens_per_minute=OPENAI_TOKENS_PER_MINUTE, max_retries=OPENAI_MAX_RETRIES):
+        self.max_retries = max_retries
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._request_bucket = TokenBucket(requests_per_minute)
+        self._token_bucket = TokenBucket(tokens_per_minute)
+        self._inflight = {}
+        self._waiters = {}
+        self._streams = {}
+        self.requests = 0
+        self.retries = 0
+        self.failures = 0
+        self.deduplicated = 0
+        self.cancelled = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+    @staticmethod
+    def build_messages(user_message, system_prompt=PROMPT):
+        return [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_message},
+        ]
+
+    @staticmethod
+    def _request_key(messages, max_tokens):
+        return hashlib.sha256(json.dumps([messages, max_tokens], ensure_ascii=False).encode()).hexdigest()
+
+    async def generate(self, user_message, system_prompt=PROMPT, max_tokens=OPENAI_MAX_TOKENS):
+        """Возвращает сгенерированный текст. Одинаковые запросы, выполняющиеся одновременно, объединяются."""
+        text, _ = await self.generate_with_usage(user_message, system_prompt, max_tokens)
+        return text
+
+    async def generate_with_usage(self, user_message, system_prompt=PROMPT, max_tokens=OPENAI_MAX_TOKENS):
+        """Как generate, но возвращает (текст, израсходовано токенов)."""
+        messages = self.build_messages(user_message, system_prompt)
+        key = self._request_key(messages, max_tokens)
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._complete(messages, max_tokens))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            self.deduplicated += 1
+        self._waiters[key] = self._waiters.get(key, 0) + 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            # Запрос к OpenAI отменяется, только если результат больше никому не нужен
+            if self._waiters[key] == 1 and not task.done():
+                task.cancel()
+                self.cancelled += 1
+            raise
+        finally:
+            self._waiters[key] -= 1
+            if not self._waiters[key]:
+                del self._waiters[key]
+
+    async def _complete(self, messages, max_tokens):
+        reserved = sum(estimate_tokens(message["content"]) for message in messages) + max_tokens
+        for attempt in range(self.max_retries + 1):
+            await self._request_bucket.acquire()
+            await self._token_bucket.acquire(reserved)
+            async with self._semaphore:
+                self.requests += 1
+                started = time.perf_counter()
+                try:
+                    response = await openai.ChatCompletion.acreate(
+                        model=OPENAI_MODEL,
+                        messages=messages,
+                        temperature=OPENAI_TEMPERATURE,
+                        max_tokens=max_tokens,
+                        request_timeout=OPENAI_TIMEOUT,
+                    )
+                except OPENAI_RETRY_ERRORS as e:
+                    openai_request_seconds.observe(time.perf_counter() - started, mode="complete", result="retryable")
+                    if attempt == self.max_retries:
+                        self.failures += 1
+                        raise
+                    self.retries += 1
+                    delay = _openai_retry_delay(e, attempt)
+                    logger.warning(f"OpenAI вернул ошибку ({e}), повтор через {delay:.1f} с")
+                except Exception:
+                    openai_request_seconds.observe(time.perf_counter() - started, mode="complete", result="error")
+                    self.failures += 1
+                    raise
+                else:
+                    openai_request_seconds.observe(time.perf_counter() - started, mode="complete", result="ok")
+                    usage = response.get("usage") or {}
+                    self.prompt_tokens += usage.get("prompt_tokens", 0)
+                    self.completion_tokens += usage.get("completion_tokens", 0)
+                    openai_tokens.inc(usage.get("prompt_tokens", 0), kind="prompt")
+                    openai_tokens.inc(usage.get("completion_tokens", 0), kind="completion")
+                    if usage.get("total_tokens"):
+                        self._token_bucket.adjust(reserved - usage["total_tokens"])
+                    return response["choices"][0]["message"]["content"], usage.get("total_tokens", 0)
+            await asyncio.sleep(delay)
+
+    async def stream(self, user_message, system_prompt=PROMPT, max_tokens=OPENAI_MAX_TOKENS):
+        """Асинхронный генератор фрагментов текста. Одинаковые одновременные запросы читают один поток OpenAI."""
+        messages = self.build_messages(user_message, system_prompt)
+        key = self._request_key(messages, max_tokens)
+        if key in self._inflight:
+            # Такой же запрос уже выполняется без потока: ждём его результат целиком
+            text, _ = await self.generate_with_usage(user_message, system_prompt, max_tokens)
+            yield text
+            return
+        shared = self._streams.get(key)
+        if shared is None:
+            shared = _SharedStream(self._stream(messages, max_tokens))
+            self._streams[key] = shared
+            shared.task.add_done_callback(lambda _: self._streams.pop(key, None))
+        else:
+            self.deduplicated += 1
+        try:
+            async with aclosing(shared.follow()) as fragments:
+                async for fragment in fragments:
+                    yield fragment
+        finally:
+            # Запрос к OpenAI прерывается, только если поток больше никто не читает
+            if not shared.consumers and not shared.task.done():
+                shared.task.cancel()
+                self.cancelled += 1
+
+    async def _stream(self, messages, max_tokens):
+        """Поток фрагментов от OpenAI. Повтор возможен, только пока не получен первый фрагмент."""
+        prompt_tokens = sum(estimate_tokens(message["content"]) for message in messages)
+        reserved = prompt_tokens + max_tokens
+        for attempt in range(self.max_retries + 1):
+            await self._request_bucket.acquire()
+            await self._token_bucket.acquire(reserved)
+            async with self._semaphore:
+                self.requests += 1
+                received = []
+                started = time.perf_counter()
+                try:
+                    response = await openai.ChatCompletion.acreate(
+                        model=OPENAI_MODEL,
+                        messages=messages,
+                        temperature=OPENAI_TEMPERATURE,
+                        max_tokens=max_tokens,
+                        request_timeout=OPENAI_TIMEOUT,
+                        stream=True,
+                    )
+                    async for chunk in response:
+                        delta = chunk["choices"][0].get("delta", {}).get("content")
+                        if delta:
+                            received.append(delta)
+                            yield delta
+                except OPENAI_RETRY_ERRORS as e:
+                    openai_request_seconds.observe(time.perf_counter() - started, mode="stream", result="retryable")
+                    if received or attempt == self.max_retries:
+                        self.failures += 1
+                        raise
+                    self.retries += 1
+                    delay = _openai_retry_delay(e, attempt)
+                    logger.warning(f"OpenAI вернул ошибку ({e}), повтор через {delay:.1f} с")
+                except Exception:
+                    openai_request_seconds.observe(time.perf_counter() - started, mode="stream", result="error")
+                    self.failures += 1
+                    raise
+                else:
+                    openai_request_seconds.observe(time.perf_counter() - started, mode="stream", result="ok")
+                    # В потоковом режиме OpenAI не сообщает расход токенов, поэтому считаем по оценке
+                    completion_tokens = estimate_tokens("".join(received))
+                    self.prompt_tokens += prompt_tokens
+                    self.completion_tokens += completion_tokens
+                    openai_tokens.inc(prompt_tokens, kind="prompt")
+                    openai_tokens.inc(completion_tokens, kind="completion")
+                    self._token_bucket.adjust(reserved - prompt_tokens - completion_tokens)
+                    return
+            await asyncio.sleep(delay)
+
+    def stats(self):
+        return {
+            "requests": self.requests,
+            "retries": self.retries,
+            "failures": self.failures,
+            "deduplicated": self.deduplicated,
+            "cancelled": self.cancelled,
+            "in_flight": len(self._inflight) + len(self._streams),
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+        }
+
+generation_service = GenerationService()
+
+# Подбор квартир под запрос и сборка промпта
+ROOM_WORDS = {
+    "студи": 0, "однокомнатн": 1, "однушк": 1, "двухкомнатн": 2, "двушк": 2,
+    "трехкомнатн": 3, "трешк": 3, "четырехкомнатн": 4,
+}
+
+@dataclass
+class InventoryQuery:
+    complexes: list
+    city: str = None
+    rooms: int = None
+    price_min: float = None
+    price_max: float = None
+
+    def __bool__(self):
+        return bool(self.complexes) or any(
+            value is not None for value in (self.city, self.rooms, self.price_min, self.price_max)
+        )
+
+# Сумма в запросе: число с необязательной денежной единицей. Числа перед площадью, этажом, годом,
+# комнатностью и т.п. ценой не считаются ("до 10 этажа", "от 40 м2", "сдача до 2026 года")
+PRICE_AMOUNT = (
+    r"(\d+(?:[.,]\d+)?)(?!\d)\s*(млн|миллион|м(?![2²\w])|тыс|т\.?р|руб|р\b|₽)?"
+    r"(?![\s-]*(?:м2|м²|кв|комн|к\b|кк\b|х\b|этаж|год|г\b|лет|мин|км|сот|метр|чел))"
+)
+
+def _parse_amount(number, unit):
+    """Сумма в рублях или None, если число не похоже на цену квартиры."""
+    value = float(number.replace(",", "."))
+    if unit and unit.startswith("м"):
+        return value * 1_000_000
+    if unit and unit.startswith("т"):
+        return value * 1_000
+    if unit:
+        return value
+    # "до 6" без единиц в разговоре о квартирах означает миллионы, "до 6500000" — рубли
+    if value < 1000:
+        return value * 1_000_000
+    return value if value >= 100_000 else None
+
+def _find_amount(prefix, text):
+    for match in re.finditer(prefix + r"\s*" + PRICE_AMOUNT, text):
+        value = _parse_amount(*match.groups())
+        if value is not None:
+            return value
+    return None
+
+def parse_inventory_query(text, source):
+    """Извлекает из запроса ЖК, город, комнатность и бюджет, сверяясь со значениями в инвентаре."""
+    text = _normalize_key(text)
+    # "6 500 000" -> "6500000"
+    text = re.sub(r"(?<=\d)[\s\u00a0](?=\d{3}\b)", "", text)
+    query = InventoryQuery(complexes=source.mentioned_complexes(text))
+    for city in source.by_city.positions:
+        # Простое совпадение по основам слов: "в краснодаре", "в ростове-на-дону"
+        stems = [part[:-1] if len(part) > 4 else part for part in re.split(r"[\s-]+", city) if part]
+        if stems and all(stem in text for stem in stems):
+            query.city = city
+            break
+    rooms = re.search(r"\b(\d)\s*-?\s*(?:к\b|кк\b|комн|х\s*комн)", text)
+    if rooms:
+        query.rooms = int(rooms.group(1))
+    else:
+        for word, count in ROOM_WORDS.items():
+            if word in text:
+                query.rooms = count
+                break
+    query.price_max = _find_amount(r"(?:\bдо|не дороже|бюджет\w*|максимум)", text)
+    query.price_min = _find_amount(r"\bот", text)
+    return query
+
+def _format_cell(column, value):
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return ""
+    if column == "Количество комнат":
+        return "студия" if value == 0 else str(value) if value > 0 else ""
+    if isinstance(value, (float, np.floating)):
+        return str(int(value)) if float(value).is_integer() else f"{value:.1f}"
+    return str(value).strip()
+
+def render_inventory_rows(rows):
+    """Компактная таблица с человеческими названиями столбцов из COLUMN_MAPPING."""
+    columns = [column for column in PROMPT_COLUMNS if column in rows.columns]
+    lines = [" | ".join(columns)]
+    for values in zip(*(rows[column].astype(object) for column in columns)):
+        lines.append(" | ".join(_format_cell(column, value) for column, value in zip(columns, values)))
+    return lines
+
+def _select_rows(source, query):
+    filters = dict(city=query.city, rooms=query.rooms, price_min=query.price_min, price_max=query.price_max)
+    if query.complexes:
+        positions = np.concatenate([
+            source.find_positions(complex_name=name, **filters) for name in query.complexes
+        ])
+    else:
+        positions = source.find_positions(**filters)
+    # Сначала самые доступные по цене варианты
+    order = np.argsort(source.prices[positions], kind="stable")
+    return positions, positions[order]
+
+def build_post_request(user_message, system_prompt=PROMPT, source=None):
+    """Текст запроса к модели: просьба пользователя и только подходящие строки инвентаря в пределах бюджета токенов."""
+    source = source if source is not None else inventory
+    if source is None:
+        return user_message
+    return _request_with_rows(user_message, parse_inventory_query(user_message, source), source, system_prompt)
+
+def _request_with_rows(user_message, query, source, system_prompt=PROMPT):
+    if not query:
+        return user_message
+    matched, ranked = _select_rows(source, query)
+    if not len(matched):
+        return (
+            f"{user_message}\n\nВ актуальной базе нет свободных квартир под эти условия. "
+            "Не придумывай конкретные цены и наличие."
+        )
+    prices = source.prices[matched]
+    summary = f"Всего подходящих свободных квартир: {len(matched)}"
+    if not np.all(np.isnan(prices)):
+        summary += f", цены от {int(np.nanmin(prices))} до {int(np.nanmax(prices))} руб."
+    head = f"{user_message}\n\nАктуальные данные о квартирах (используй только их):\n{summary}\n"
+    lines = render_inventory_rows(source.df.iloc[ranked[:PROMPT_MAX_ROWS]])
+    budget = PROMPT_TOKEN_BUDGET - estimate_tokens(system_prompt) - estimate_tokens(head)
+    selected = []
+    for line in lines:
+        budget -= estimate_tokens(line) + 1
+        if budget < 0:
+            break
+        selected.append(line)
+    if len(selected) <= 1:
+        return head
+    return head + "\n".join(selected)
+
+# Кэш сгенерированных постов
+def normalize_prompt(text):
+    text = text.casefold().replace("ё", "е")
+    return re.sub(r"\s+", " ", text).strip(" .,!?")
+
+class PostCache:
+    """Постоянный кэш постов в SQLite с TTL и вытеснением давно не использованных записей."""
+
+    def __init__(self, path=POST_CACHE_PATH, ttl=POST_CACHE_TTL, max_entries=POST_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._connection = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
+        self.saved_tokens = 0
+        self.invalidated = 0
+        self.hit_time_total = 0.0
+        self.miss_time_total = 0.0
+
+    @staticmethod
+    def make_key(user_message, system_prompt, version):
+        prompt_hash = hashlib.sha256(system_prompt.encode()).hexdigest()
+        raw = "\x1f".join([normalize_prompt(user_message), prompt_hash, version])
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    def _connect(self):
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS posts ("
+                "key TEXT PRIMARY KEY, response TEXT NOT NULL, tokens INTEGER NOT NULL, "
+                "complexes TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)"
+            )
+            self._connection.execute("CREATE INDEX IF NOT EXISTS posts_accessed ON posts (accessed)")
+        return self._connection
+
+    def _get(self, key):
+        now = time.time()
+        with self._lock:
+            db = self._connect()
+            row = db.execute("SELECT response, tokens, created FROM posts WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if now - row[2] > self.ttl:
+                db.execute("DELETE FROM posts WHERE key = ?", (key,))
+                db.commit()
+                return None
+            db.execute("UPDATE posts SET accessed = ? WHERE key = ?", (now, key))
+            db.commit()
+            return row[0], row[1]
+
+    def _put(self, key, response, tokens, complexes):
+        now = time.time()
+        with self._lock:
+            db = self._connect()
+            db.execute(
+                "INSERT OR REPLACE INTO posts VALUES (?, ?, ?, ?, ?, ?)",
+                (key, response, tokens, "".join(f"|{name}|" for name in complexes), now, now),
+            )
+            db.execute("DELETE FROM posts WHERE created < ?", (now - self.ttl,))
+            db.execute(
+                "DELETE FROM posts WHERE key IN ("
+                "SELECT key FROM posts ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+            db.commit()
+
+    def _invalidate(self, complexes):
+        # Посты без привязки к ЖК строились по всей таблице и тоже устаревают
+        with self._lock:
+            db = self._connect()
+            deleted = db.execute("DELETE FROM posts WHERE complexes = ''").rowcount
+            for name in complexes:
+                deleted += db.execute(
+                    "DELETE FROM posts WHERE instr(complexes, ?) > 0", (f"|{name}|",)
+                ).rowcount
+            db.commit()
+            return deleted
+
+    async def get(self, key):
+        """Возвращает (текст, токены) или None."""
+        return await asyncio.to_thread(self._get, key)
+
+    async def put(self, key, response, tokens, complexes=()):
+        await asyncio.to_thread(self._put, key, response, tokens, list(complexes))
+
+    async def invalidate(self, complexes):
+        try:
+            deleted = await asyncio.to_thread(self._invalidate, list(complexes))
+        except Exception as e:
+            logger.error(f"Ошибка очистки кэша постов: {e}")
+            return
+        self.invalidated += deleted
+        if deleted:
+            logger.info(f"Из кэша удалено устаревших постов: {deleted}")
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "saved_tokens": self.saved_tokens,
+            "invalidated": self.invalidated,
+            "avg_hit_seconds": self.hit_time_total / self.hits if self.hits else 0.0,
+            # Время промаха считается для постов, которые удалось сгенерировать и сохранить
+            "avg_miss_seconds": self.miss_time_total / self.stored if self.stored else 0.0,
+        }
+
+post_cache = PostCache()
+
+def prepare_post(user_message, source=None):
+    """Разбирает запрос один раз для кэша и для модели: (ключ кэша, упомянутые ЖК, текст запроса к модели).
+    Версия данных хэширует таблицу, поэтому функция синхронная и вызывается через asyncio.to_thread."""
+    source = source if source is not None else inventory
+    if source is None:
+        return post_cache.make_key(user_message, PROMPT, "-"), [], user_message
+    query = parse_inventory_query(user_message, source)
+    key = post_cache.make_key(user_message, PROMPT, source.snapshot_version(query.complexes))
+    return key, query.complexes, _request_with_rows(user_message, query, source)
+
+async def _cached_post(key, started):
+    """Текст поста из кэша или None."""
+    try:
+        cached = await post_cache.get(key)
+    except Exception as e:
+        logger.error(f"Ошибка чтения кэша постов: {e}")
+        cached = None
+    if cached is None:
+        post_cache.misses += 1
+        return None
+    post_cache.hits += 1
+    post_cache.saved_tokens += cached[1]
+    post_cache.hit_time_total += time.monotonic() - started
+    return cached[0]
+
+async def _store_post(key, text, tokens, complexes, started):
+    post_cache.stored += 1
+    post_cache.miss_time_total += time.monotonic() - started
+    try:
+        await post_cache.put(key, text, tokens, complexes)
+    except Exception as e:
+        logger.error(f"Ошибка записи в кэш постов: {e}")
+
+async def generate_post(user_message):
+    """Пост по запросу пользователя: из кэша, если данные по упомянутым ЖК не менялись, иначе через OpenAI."""
+    started = time.monotonic()
+    key, complexes, request_text = await asyncio.to_thread(prepare_post, user_message)
+    cached = await _cached_post(key, started)
+    if cached is not None:
+        return cached
+    text, tokens = await generation_service.generate_with_usage(request_text)
+    await _store_post(key, text, tokens, complexes, started)
+    return text
+
+# Исходящие сообщения Telegram с учётом лимитов Bot API
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 10
+
+def split_message(text, limit=MessageLimit.MAX_TEXT_LENGTH):
+    """Делит текст на части не длиннее limit, по возможности по абзацам, строкам или пробелам."""
+    parts = []
+    while len(text) > limit:
+        cut = -1
+        for separator in ("\n\n", "\n", " "):
+            cut = text.rfind(separator, 0, limit)
+            if cut > 0:
+                break
+        if cut <= 0:
+            cut = limit
+        parts.append(text[:cut])
+        text = text[cut:].lstrip()
+    if text or not parts:
+        parts.append(text)
+    return parts
+
+@dataclass
+class _SendJob:
+    chat_id: object
+    request: object
+    future: asyncio.Future
+    enqueued: float
+    per_chat: bool = True
+    attempts: int = 0
+
+class TelegramSender:
+    """Очередь исходящих вызовов Bot API: не больше global_rate сообщений в секунду на бота и не чаще одного
+    сообщения в чат за chat_interval (group_interval для групп и каналов). Интерактивные ответы идут раньше
+    пакетных публикаций, сообщения одного чата отправляются по порядку, RetryAfter выдерживается."""
+
+    def __init__(
+        self,
+        global_rate=TELEGRAM_GLOBAL_RATE,
+        chat_interval=TELEGRAM_CHAT_INTERVAL,
+        group_interval=TELEGRAM_GROUP_INTERVAL,
+        concurrency=TELEGRAM_SEND_CONCURRENCY,
+        max_retries=TELEGRAM_SEND_RETRIES,
+    ):
+        self.global_interval = 1 / global_rate
+        self.chat_interval = chat_interval
+        self.group_interval = group_interval
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self._pending = []  # [(приоритет, порядковый номер, задание)]
+        self._seq = 0
+        self._busy_chats = set()
+        self._chat_ready = {}
+        self._global_ready = 0.0
+        self._in_flight = 0
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._sending = set()
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def _interval(self, chat_id):
+        # Отрицательные id и @username относятся к группам и каналам
+        if isinstance(chat_id, str) or chat_id < 0:
+            return self.group_interval
+        return self.chat_interval
+
+    def enqueue(self, chat_id, request, priority=PRIORITY_INTERACTIVE, per_chat=True):
+        """Ставит в очередь вызов Bot API. request — функция без аргументов, возвращающая корутину.
+        per_chat=False — только общий лимит бота, без очереди чата (статусы вроде «печатает…»).
+        Возвращает future с результатом вызова."""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        job = _SendJob(chat_id, request, asyncio.get_running_loop().create_future(), time.monotonic(), per_chat)
+        self._push(priority, self._next_seq(), job)
+        return job.future
+
+    async def submit(self, chat_id, request, priority=PRIORITY_INTERACTIVE, per_chat=True):
+        return await self.enqueue(chat_id, request, priority, per_chat)
+
+    async def send_message(self, bot, chat_id, text, priority=PRIORITY_INTERACTIVE, formatter=None):
+        """Отправляет текст, при необходимости разбивая его на несколько сообщений. formatter переводит
+        каждую часть в HTML; если Telegram не принял разметку, часть уходит простым текстом."""
+        # Запас под теги и экранирование, которые добавит formatter
+        limit = MessageLimit.MAX_TEXT_LENGTH - (256 if formatter else 0)
+        futures = [
+            self.enqueue(chat_id, lambda part=part: self._send_part(bot, chat_id, part, formatter), priority)
+            for part in split_message(text, limit)
+        ]
+        return await asyncio.gather(*futures)
+
+    @staticmethod
+    async def _send_part(bot, chat_id, text, formatter):
+        if formatter is None:
+            return await bot.send_message(chat_id=chat_id, text=text)
+        try:
+            return await bot.send_message(chat_id=chat_id, text=formatter(text), parse_mode=ParseMode.HTML)
+        except BadRequest as e:
+            logger.warning(f"Telegram не принял разметку, отправляю текст как есть: {e}")
+            return await bot.send_message(chat_id=chat_id, text=text)
+
+    def _next_seq(self):
+        self._seq += 1
+        return self._seq
+
+    def _push(self, priority, seq, job):
+        self._pending.append((priority, seq, job))
+        self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            delay = self._dispatch()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def _dispatch(self):
+        """Запускает все задания, которые уже можно отправить. Возвращает время до следующей проверки
+        (None — ждать нового задания или завершения отправки)."""
+        now = time.monotonic()
+        delay = None
+        remaining = []
+        self._pending.sort(key=lambda entry: entry[:2])
+        for index, entry in enumerate(self._pending):
+            priority, seq, job = entry
+            if job.future.done():
+                # Вызывающий код уже отменил ожидание
+                continue
+            if self._in_flight >= self.concurrency:
+                remaining.extend(self._pending[index:])
+                break
+            chat_ready = self._chat_ready.get(job.chat_id, 0.0) if job.per_chat else 0.0
+            if job.per_chat and (job.chat_id in self._busy_chats or chat_ready > now):
+                if job.chat_id not in self._busy_chats:
+                    delay = chat_ready - now if delay is None else min(delay, chat_ready - now)
+                remaining.append(entry)
+                continue
+            if self._global_ready > now:
+                delay = self._global_ready - now if delay is None else min(delay, self._global_ready - now)
+                remaining.append(entry)
+                continue
+            self._global_ready = max(self._global_ready, now) + self.global_interval
+            if job.per_chat:
+                self._chat_ready[job.chat_id] = now + self._interval(job.chat_id)
+                self._busy_chats.add(job.chat_id)
+            self._in_flight += 1
+            task = asyncio.create_task(self._send(priority, seq, job))
+            self._sending.add(task)
+            task.add_done_callback(self._sending.discard)
+        self._pending = remaining
+        return delay
+
+    async def _send(self, priority, seq, job):
+        started = time.perf_counter()
+        telegram_queue_seconds.observe(
+            time.monotonic() - job.enqueued, priority="batch" if priority >= PRIORITY_BATCH else "interactive"
+        )
+        try:
+            result = await job.request()
+        except RetryAfter as e:
+            telegram_send_seconds.observe(time.perf_counter() - started, result="retry_after")
+            self._retry(priority, seq, job, e, float(e.retry_after))
+        except BadRequest as e:
+            telegram_send_seconds.observe(time.perf_counter() - started, result="bad_request")
+            self._fail(job, e)
+        except NetworkError as e:
+            telegram_send_seconds.observe(time.perf_counter() - started, result="network_error")
+            self._retry(priority, seq, job, e, 2 ** job.attempts)
+        except Exception as e:
+            telegram_send_seconds.observe(time.perf_counter() - started, result="error")
+            self._fail(job, e)
+        else:
+            telegram_send_seconds.observe(time.perf_counter() - started, result="ok")
+            latency = time.monotonic() - job.enqueued
+            self.sent += 1
+            self.latency_total += latency
+            self.latency_max = max(self.latency_max, latency)
+            if not job.future.done():
+                job.future.set_result(result)
+        finally:
+            self._in_flight -= 1
+            if job.per_chat:
+                self._busy_chats.discard(job.chat_id)
+            self._wakeup.set()
+
+    def _retry(self, priority, seq, job, error, delay):
+        job.attempts += 1
+        if isinstance(error, RetryAfter):
+            self._chat_ready[job.chat_id] = max(self._chat_ready.get(job.chat_id, 0.0), time.monotonic() + delay)
+        # Статус чата к моменту повтора уже неактуален
+        if job.attempts > self.max_retries or not job.per_chat:
+            self._fail(job, error)
+            return
+        self.retries += 1
+        logger.warning(f"Повтор отправки в чат {job.chat_id} через {delay:.1f} с: {error}")
+        self._chat_ready[job.chat_id] = time.monotonic() + delay
+        # Задание возвращается на своё место в очереди, порядок сообщений чата сохраняется
+        self._push(priority, seq, job)
+
+    def _fail(self, job, error):
+        self.failed += 1
+        if not job.future.done():
+            job.future.set_exception(error)
+
+    def stats(self):
+        return {
+            "queued": len(self._pending),
+            "queued_batch": sum(1 for priority, _, _ in self._pending if priority >= PRIORITY_BATCH),
+            "in_flight": self._in_flight,
+            "sent": self.sent,
+            "failed": self.failed,
+            "retries": self.retries,
+            "avg_latency": self.latency_total / self.sent if self.sent else 0.0,
+            "max_latency": self.latency_max,
+        }
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        self._wakeup = asyncio.Event()
+        for _, _, job in self._pending:
+            if not job.future.done():
+                job.future.cancel()
+        self._pending = []
+
+telegram_sender = TelegramSender()
+
+async def reply_text(update: Update, text):
+    """Ответ в чат обновления через общую очередь исходящих сообщений."""
+    return await telegram_sender.send_message(update.get_bot(), update.effective_chat.id, text)
+
+# Потоковая выдача поста
+def format_post_html(text):
+    """Переводит **жирный** текст из ответа модели в HTML-разметку Telegram."""
+    return re.sub(r"\*\*(.+?)\*\*", r"<b>\1</b>", html.escape(text, quote=False), flags=re.S)
+
+class StreamingReply:
+    """Показывает текст в сообщении Telegram по мере генерации, объединяя правки не чаще раза в interval секунд."""
+
+    def __init__(self, bot, chat_id, started=None, interval=STREAM_EDIT_INTERVAL):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.started = started if started is not None else time.monotonic()
+        self.interval = interval
+        self.text = ""
+        self.first_visible = None
+        self._message = None
+        self._shown = ""
+        self._next_edit = 0.0
+
+    async def feed(self, delta):
+        self.text += delta
+        if time.monotonic() >= self._next_edit:
+            await self._flush()
+
+    async def finish(self):
+        await self._flush(final=True)
+
+    async def _flush(self, final=False):
+        # Длинный текст продолжается в новом сообщении
+        while len(self.text) > MessageLimit.MAX_TEXT_LENGTH:
+            cut = self.text.rfind("\n", 0, MessageLimit.MAX_TEXT_LENGTH)
+            if cut <= 0:
+                cut = MessageLimit.MAX_TEXT_LENGTH
+            part, self.text = self.text[:cut], self.text[cut:].lstrip("\n")
+            await self._show(part, final=True)
+            self._message = None
+            self._shown = ""
+        if self.text.strip():
+            await self._show(self.text, final=final)
+        self._next_edit = time.monotonic() + self.interval
+
+    async def _show(self, text, final):
+        if text == self._shown and not final:
+            return
+        try:
+            if final:
+                await self._send_or_edit(format_post_html(text), parse_mode=ParseMode.HTML)
+            else:
+                await self._send_or_edit(text)
+        except RetryAfter as e:
+            if final:
+                await asyncio.sleep(e.retry_after)
+                await self._send_or_edit(text)
+            else:
+                self._next_edit = time.monotonic() + e.retry_after
+                return
+        except BadRequest as e:
+            if "not modified" in str(e).lower():
+                return
+            if not final:
+                raise
+            # Разметка не прошла проверку Telegram, показываем текст как есть
+            await self._send_or_edit(text)
+        self._shown = text
+        if self.first_visible is None:
+            self.first_visible = time.monotonic() - self.started
+
+    async def _send_or_edit(self, text, parse_mode=None):
+        if self._message is None:
+            self._message = await telegram_sender.submit(
+                self.chat_id, lambda: self.bot.send_message(chat_id=self.chat_id, text=text, parse_mode=parse_mode)
+            )
+        else:
+            message_id = self._message.message_id
+            try:
+                await telegram_sender.submit(self.chat_id, lambda: self.bot.edit_message_text(
+                    text=text, chat_id=self.chat_id, message_id=message_id, parse_mode=parse_mode
+                ))
+            except BadRequest as e:
+                if "not modified" not in str(e).lower():
+                    raise
+
+stream_stats = {"replies": 0, "first_visible_total": 0.0}
+
+def _with_signature(text, signature):
+    return f"{text}\n{signature}" if signature else text
+
+async def stream_post(bot, chat_id, user_message, signature=""):
+    """Отправляет пост в чат, показывая текст по мере генерации. Подпись агента добавляется в конце.
+    Возвращает текст поста без подписи или None, если сгенерировать его не удалось."""
+    started = time.monotonic()
+    key, complexes, request_text = await asyncio.to_thread(prepare_post, user_message)
+    cached = await _cached_post(key, started)
+    reply = StreamingReply(bot, chat_id, started)
+    if cached is not None:
+        reply.text = _with_signature(cached, signature)
+        await reply.finish()
+        return cached
+    # Текст в reply может уйти частями в несколько сообщений, поэтому весь пост собирается отдельно
+    generated = []
+    try:
+        async with aclosing(generation_service.stream(request_text)) as fragments:
+            async for fragment in fragments:
+                generated.append(fragment)
+                await reply.feed(fragment)
+    except Exception as e:
+        logger.error(f"Ошибка при обращении к OpenAI: {e}")
+        if not generated:
+            await telegram_sender.send_message(bot, chat_id, "Произошла ошибка при генерации ответа.")
+            return None
+        # Оборванный текст остаётся на экране с пометкой, но не попадает ни в кэш, ни в историю
+        await reply.feed("\n\n⚠️ Генерация прервалась из-за ошибки, повторите запрос.")
+        await reply.finish()
+        return None
+    full_text = "".join(generated)
+    if signature:
+        await reply.feed("\n" + signature)
+    await reply.finish()
+    stream_stats["replies"] += 1
+    stream_stats["first_visible_total"] += reply.first_visible or 0.0
+    await _store_post(key, full_text, estimate_tokens(PROMPT + request_text + full_text), complexes, started)
+    return full_text
+
+async def deliver_post(bot, chat_id, user_message, signature=""):
+    if STREAM_REPLIES:
+        post = await stream_post(bot, chat_id, user_message, signature)
+    else:
+        try:
+            post = await generate_post(user_message)
+        except Exception as e:
+            logger.error(f"Ошибка при обращении к OpenAI: {e}")
+            post = None
+        response = _with_signature(post, signature) if post else "Произошла ошибка при генерации ответа."
+        await telegram_sender.send_message(bot, chat_id, response)
+    if post:
+        await state_store.append_history(chat_id, user_message, post)
+
+# Пакетная генерация постов по ЖК или по изменениям прайса
+@dataclass
+class BatchReport:
+    posts: int = 0
+    failures: int = 0
+    published: int = 0
+    tokens: int = 0
+    seconds: float = 0.0
+
+    @property
+    def posts_per_minute(self):
+        return self.posts / self.seconds * 60 if self.seconds else 0.0
+
+    def summary(self):
+        return (
+            f"постов: {self.posts}, ошибок: {self.failures}, опубликовано: {self.published}, "
+            f"токенов: {self.tokens}, время: {self.seconds:.0f} с, {self.posts_per_minute:.1f} постов/мин"
+        )
+
+def build_batch_requests(source, changes=None, limit=None):
+    """Запросы на пакетную генерацию: [(ЖК, текст запроса)] по всем ЖК со свободными квартирами или по изменениям прайса."""
+    requests = []
+    if changes is None:
+        for positions in source.by_complex.positions.values():
+            if not source.available[positions].any():
+                continue
+            name = str(source.df["Название ЖК"].iloc[positions[0]])
+            requests.append((name, build_post_request(f"Сделай продающий пост про {name}", source=source)))
+    else:
+        frame = pd.concat([changes.price_drops, changes.new_promotions])
+        frame = frame[~frame.index.duplicated()]
+        if frame.empty or "Название ЖК" not in frame.columns:
+            return []
+        for name, rows in frame.groupby(frame["Название ЖК"].astype(str), sort=True):
+            lines = render_inventory_rows(rows.head(PROMPT_MAX_ROWS))
+            requests.append((name, (
+                f"Сделай пост о снижении цен и новых акциях в {name}.\n\n"
+                "Изменения в прайсе (используй только эти данные):\n" + "\n".join(lines)
+            )))
+    return requests[:limit] if limit else requests
+
+def _append_batch_result(record):
+    with open(BATCH_OUTPUT_FILE, "a", encoding="utf-8") as f:
+        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+async def run_batch(requests, bot=None, channel_id=None, mode="complexes"):
+    """Генерирует посты параллельно (не больше BATCH_CONCURRENCY). Результаты пишутся в очередь на проверку
+    (BATCH_OUTPUT_FILE) и, если передан бот и канал, сразу публикуются."""
+    report = BatchReport()
+    started = time.monotonic()
+    batch_id = time.strftime("%Y%m%d-%H%M%S")
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+    async def generate_one(name, request_text):
+        async with semaphore:
+            try:
+                text, tokens = await generation_service.generate_with_usage(request_text)
+            except Exception as e:
+                report.failures += 1
+                logger.error(f"Ошибка пакетной генерации для {name}: {e}")
+                return
+        report.posts += 1
+        report.tokens += tokens
+        published = False
+        if bot is not None and channel_id:
+            try:
+                await telegram_sender.send_message(
+                    bot, channel_id, text, priority=PRIORITY_BATCH, formatter=format_post_html
+                )
+                published = True
+                report.published += 1
+            except Exception as e:
+                logger.error(f"Ошибка публикации поста про {name}: {e}")
+        await asyncio.to_thread(_append_batch_result, {
+            "batch": batch_id,
+            "mode": mode,
+            "complex": name,
+            "text": text,
+            "tokens": tokens,
+            "published": published,
+            "created": time.time(),
+        })
+
+    await asyncio.gather(*(generate_one(name, text) for name, text in requests))
+    report.seconds = time.monotonic() - started
+    logger.info(f"Пакет {batch_id} ({mode}): {report.summary()}")
+    return report
+
+_batch_tasks = set()
+
+async def batch_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/batch [changes] [publish] — посты по всем ЖК или по последним изменениям прайса."""
+    if await authorize(update, "batch") is None:
+        return
+    args = {arg.casefold() for arg in context.args or []}
+    if inventory is None:
+        await reply_text(update, "Данные ещё не загружены.")
+        return
+    changes = None
+    if "changes" in args:
+        changes = last_inventory_changes
+        if not changes:
+            await reply_text(update, "С последнего обновления изменений в прайсе нет.")
+            return
+    requests = await asyncio.to_thread(build_batch_requests, inventory, changes)
+    channel_id = TELEGRAM_CHANNEL_ID if "publish" in args else None
+    chat_id = update.effective_chat.id
+    await reply_text(update, f"Запускаю пакетную генерацию: {len(requests)} постов.")
+
+    async def run():
+        report = await run_batch(requests, context.bot, channel_id, "changes" if changes else "complexes")
+        await telegram_sender.send_message(context.bot, chat_id, f"Пакет готов: {report.summary()}")
+
+    # Пакет выполняется в фоне, чтобы не задерживать очередь сообщений чата
+    task = asyncio.create_task(run())
+    _batch_tasks.add(task)
+    task.add_done_callback(_batch_tasks.discard)
+
+async def batch_cli(argv):
+    """python main.py batch [--changes] [--publish] [--limit N]"""
+    parser = argparse.ArgumentParser(prog="main.py batch", description="Пакетная генерация постов")
+    parser.add_argument("--changes", action="store_true", help="посты только по снижениям цен и новым акциям")
+    parser.add_argument("--publish", action="store_true", help="сразу публиковать в TELEGRAM_CHANNEL_ID")
+    parser.add_argument("--limit", type=int, help="не больше N постов")
+    args = parser.parse_args(argv)
+
+    openai.aiosession.set(get_http_session())
+    try:
+        await restore_inventory()
+        changes = None
+        if args.changes:
+            # Изменения считаются относительно последнего снимка
+            changes = await refresh_data()
+            if not changes:
+                print("Изменений в прайсе нет.")
+                return
+        elif inventory is None:
+            await refresh_data()
+        requests = await asyncio.to_thread(build_batch_requests, inventory, changes, args.limit)
+        mode = "changes" if changes else "complexes"
+        if args.publish:
+            async with Bot(TELEGRAM_BOT_TOKEN) as bot:
+                report = await run_batch(requests, bot, TELEGRAM_CHANNEL_ID, mode)
+        else:
+            report = await run_batch(requests, mode=mode)
+        print(report.summary())
+    finally:
+        await telegram_sender.stop()
+        await close_http_session()
+
+# Голосовые сообщения: перекодирование и распознавание речи
+class VoiceProcessingError(Exception):
+    pass
+
+async def transcode_audio(audio, audio_format="wav", sample_rate=16000):
+    """Перекодирует аудио через ffmpeg в отдельном процессе, данные передаются через pipe без временных файлов."""
+    process = await asyncio.create_subprocess_exec(
+        FFMPEG_BINARY, "-hide_banner", "-loglevel", "error",
+        "-i", "pipe:0", "-ac", "1", "-ar", str(sample_rate), "-f", audio_format, "pipe:1",
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    try:
+        output, errors = await process.communicate(audio)
+    except asyncio.CancelledError:
+        process.kill()
+        await process.wait()
+        raise
+    if process.returncode != 0:
+        raise VoiceProcessingError(f"ffmpeg завершился с кодом {process.returncode}: {errors.decode(errors='ignore')[-300:]}")
+    return output
+
+class OpenAITranscriber:
+    """Распознавание через Whisper API. Голосовые Telegram (ogg/opus) передаются без перекодирования."""
+    audio_format = "ogg"
+
+    async def transcribe(self, audio, audio_format):
+        audio_file = io.BytesIO(audio)
+        audio_file.name = f"voice.{audio_format}"
+        result = await openai.Audio.atranscribe(
+            OPENAI_TRANSCRIBE_MODEL, audio_file, language="ru", request_timeout=VOICE_TIMEOUT
+        )
+        return result["text"]
+
+class StubTranscriber:
+    """Заглушка для тестов и локального запуска: проверяет перекодирование и возвращает фиксированный текст."""
+    audio_format = "wav"
+
+    async def transcribe(self, audio, audio_format):
+        if not audio:
+            raise VoiceProcessingError("Пустой аудиофайл")
+        return "Голосовое сообщение успешно преобразовано."
+
+TRANSCRIBERS = {
+    "openai": OpenAITranscriber,
+    "stub": StubTranscriber,
+}
+
+class VoicePipeline:
+    """Очередь распознавания голосовых: ограничение параллельности и тайм-аут на каждую задачу."""
+
+    def __init__(self, transcriber, concurrency=VOICE_CONCURRENCY, timeout=VOICE_TIMEOUT):
+        self.transcriber = transcriber
+        self.timeout = timeout
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self.jobs = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.seconds_total = 0.0
+
+    async def transcribe(self, audio, source_format="ogg"):
+        async with self._semaphore:
+            started = time.monotonic()
+            self.jobs += 1
+            try:
+                return await asyncio.wait_for(self._run(audio, source_format), self.timeout)
+            except asyncio.TimeoutError:
+                self.timeouts += 1
+                raise
+            except Exception:
+                self.failures += 1
+                raise
+            finally:
+                self.seconds_total += time.monotonic() - started
+
+    async def _run(self, audio, source_format):
+        audio_format = self.transcriber.audio_format
+        if audio_format != source_format:
+            audio = await transcode_audio(audio, audio_format)
+        text = await self.transcriber.transcribe(audio, audio_format)
+        return text.strip()
+
+    def stats(self):
+        return {
+            "jobs": self.jobs,
+            "failures": self.failures,
+            "timeouts": self.timeouts,
+            "avg_seconds": self.seconds_total / self.jobs if self.jobs else 0.0,
+        }
+
+voice_pipeline = VoicePipeline(TRANSCRIBERS[TRANSCRIBER]())
+
+# Профили агентов: подпись с контактами, доступные команды и квоты
+# Без явного разрешения в профиле доступны только запросы постов; refresh и batch нужно разрешить отдельно
+DEFAULT_AGENT_COMMANDS = frozenset({"post", "voice", "history"})
+
+@dataclass
+class AgentProfile:
+    user_id: int = None
+    username: str = None
+    name: str = ""
+    signature: str = ""
+    commands: frozenset = DEFAULT_AGENT_COMMANDS  # None ("*" в файле) — доступны все команды
+    posts_per_minute: int = 0  # 0 — без ограничения
+    posts_per_day: int = 0
+
+    def allows(self, command):
+        return self.commands is None or command in self.commands
+
+def _agent_profile(record, default):
+    commands = record.get("commands", default.commands)
+    return AgentProfile(
+        user_id=int(record["user_id"]) if record.get("user_id") is not None else None,
+        username=(record.get("username") or "").lstrip("@") or None,
+        name=record.get("name", ""),
+        signature=record.get("signature", default.signature),
+        commands=frozenset(commands) if commands is not None and "*" not in commands else None,
+        posts_per_minute=int(record.get("posts_per_minute", default.posts_per_minute)),
+        posts_per_day=int(record.get("posts_per_day", default.posts_per_day)),
+    )
+
+class AgentRegistry:
+    """Профили агентов из JSON-файла AGENTS_FILE с поиском по id и username пользователя Telegram.
+
+    Файл перечитывается при изменении (проверка не чаще раза в check_interval секунд). Пока файла нет,
+    всем доступны DEFAULT_AGENT_COMMANDS без квот. Команды: post и voice (текстовые и голосовые запросы постов),
+    refresh, batch, history.
+    """
+
+    def __init__(self, path=AGENTS_FILE, check_interval=AGENTS_RELOAD_INTERVAL):
+        self.path = path
+        self.check_interval = check_interval
+        self.default = AgentProfile()
+        self.by_id = {}
+        self.by_username = {}
+        self._mtime = None
+        self._checked = None
+        self._usage = {}  # user_id -> (отметки времени за последнюю минуту, дата, постов за дату)
+        self.count = 0
+        self.rejected = 0
+
+    def _maybe_reload(self):
+        now = time.monotonic()
+        if self._checked is not None and now - self._checked < self.check_interval:
+            return
+        self._checked = now
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime == self._mtime:
+            return
+        self._mtime = mtime
+        if mtime is None:
+            self.default, self.by_id, self.by_username = AgentProfile(), {}, {}
+            self.count = 0
+            return
+        try:
+            self._load()
+        except (OSError, ValueError, TypeError, KeyError) as e:
+            # Ошибка в файле не должна сбрасывать уже загруженные профили
+            logger.error(f"Не удалось загрузить профили агентов из {self.path}: {e}")
+
+    def _load(self):
+        with open(self.path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        default = _agent_profile(data.get("default", {}), AgentProfile())
+        by_id, by_username = {}, {}
+        for record in data.get("agents", []):
+            profile = _agent_profile(record, default)
+            if profile.user_id is not None:
+                by_id[profile.user_id] = profile
+            if profile.username:
+                by_username[profile.username.casefold()] = profile
+        self.default, self.by_id, self.by_username = default, by_id, by_username
+        self.count = len(data.get("agents", []))
+        logger.info(f"Профили агентов загружены: {self.count}")
+
+    def get(self, user):
+        """Профиль пользователя Telegram (telegram.User или None); незнакомым достаётся профиль по умолчанию."""
+        self._maybe_reload()
+        if user is None:
+            return self.default
+        profile = self.by_id.get(user.id)
+        if profile is None and user.username:
+            profile = self.by_username.get(user.username.casefold())
+        return profile or self.default
+
+    def consume(self, user_id, profile):
+        """Учитывает запрос поста в квотах агента. Возвращает текст отказа или None."""
+        if not profile.posts_per_minute and not profile.posts_per_day:
+            return None
+        now = time.time()
+        today = time.strftime("%Y-%m-%d")
+        if len(self._usage) > AGENT_USAGE_MAX_USERS:
+            # Вчерашние счётчики больше не нужны; сегодняшние хранят дневную квоту
+            self._usage = {key: value for key, value in self._usage.items() if value[1] == today}
+        recent, day, count = self._usage.get(user_id) or (deque(), today, 0)
+        if day != today:
+            day, count = today, 0
+        while recent and now - recent[0] >= 60:
+            recent.popleft()
+        if profile.posts_per_minute and len(recent) >= profile.posts_per_minute:
+            self.rejected += 1
+            return "Слишком много запросов подряд, попробуйте через минуту."
+        if profile.posts_per_day and count >= profile.posts_per_day:
+            self.rejected += 1
+            return "Дневной лимит постов исчерпан, попробуйте завтра."
+        recent.append(now)
+        self._usage[user_id] = (recent, day, count + 1)
+        return None
+
+    def stats(self):
+        return {"agents": self.count, "rejected": self.rejected}
+
+agent_registry = AgentRegistry()
+
+# Постоянное состояние: принятые обновления, задания генерации и история чатов
+class StateStore:
+    """Очередь принятых обновлений, незавершённые генерации и короткая история чатов в SQLite (WAL).
+
+    Обновление сохраняется до ответа Telegram и удаляется после обработки; запрос поста превращается
+    в задание, которое удаляется после отправки. После перезапуска main() продолжает всё незавершённое.
+    id принятых обновлений хранятся max_age секунд, чтобы повторная доставка не запускала генерацию ещё раз.
+    История каждого чата обрезается до history_limit записей.
+    """
+
+    def __init__(self, path=STATE_DB_PATH, max_attempts=STATE_MAX_ATTEMPTS, max_age=STATE_MAX_AGE,
+                 history_limit=CHAT_HISTORY_LIMIT, history_max_chars=CHAT_HISTORY_MAX_CHARS):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.max_age = max_age
+        self.history_limit = history_limit
+        self.history_max_chars = history_max_chars
+        self._connection = None
+        self._lock = threading.Lock()
+        self._seen_pruned = 0.0
+        self.resumed_updates = 0
+        self.resumed_jobs = 0
+        self.dropped = 0
+
+    def _connect(self):
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS updates ("
+                "update_id INTEGER PRIMARY KEY, payload TEXT NOT NULL, received REAL NOT NULL, "
+                "attempts INTEGER NOT NULL DEFAULT 0)"
+            )
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, chat_id INTEGER NOT NULL, kind TEXT NOT NULL, "
+                "payload TEXT NOT NULL, created REAL NOT NULL, attempts INTEGER NOT NULL DEFAULT 0)"
+            )
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS seen_updates (update_id INTEGER PRIMARY KEY, seen REAL NOT NULL)"
+            )
+            self._connection.execute("CREATE INDEX IF NOT EXISTS seen_updates_seen ON seen_updates (seen)")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS chat_history ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, chat_id INTEGER NOT NULL, request TEXT NOT NULL, "
+                "response TEXT NOT NULL, created REAL NOT NULL)"
+            )
+            self._connection.execute("CREATE INDEX IF NOT EXISTS chat_history_chat ON chat_history (chat_id, id)")
+        return self._connection
+
+    def _add_update(self, update_data):
+        now = time.time()
+        with self._lock:
+            db = self._connect()
+            if now - self._seen_pruned > SEEN_UPDATES_PRUNE_INTERVAL:
+                db.execute("DELETE FROM seen_updates WHERE seen < ?", (now - self.max_age,))
+                self._seen_pruned = now
+            # Обновление считается принятым, пока его id в seen_updates, даже если оно уже стало заданием
+            added = db.execute(
+                "INSERT OR IGNORE INTO seen_updates (update_id, seen) VALUES (?, ?)", (update_data["update_id"], now)
+            ).rowcount
+            if added:
+                db.execute(
+                    "INSERT OR IGNORE INTO updates (update_id, payload, received) VALUES (?, ?, ?)",
+                    (update_data["update_id"], json.dumps(update_data, ensure_ascii=False), now),
+                )
+            db.commit()
+            return added > 0
+
+    def _remove_update(self, update_id, forget):
+        with self._lock:
+            db = self._connect()
+            db.execute("DELETE FROM updates WHERE update_id = ?", (update_id,))
+            if forget:
+                db.execute("DELETE FROM seen_updates WHERE update_id = ?", (update_id,))
+            db.commit()
+
+    def _start_job(self, update_id, chat_id, kind, payload):
+        # Обновление заменяется заданием в одной транзакции, чтобы после перезапуска не выполнить запрос дважды
+        with self._lock:
+            db = self._connect()
+            job_id = db.execute(
+                "INSERT INTO jobs (chat_id, kind, payload, created) VALUES (?, ?, ?, ?)",
+                (chat_id, kind, json.dumps(payload, ensure_ascii=False), time.time()),
+            ).lastrowid
+            db.execute("DELETE FROM updates WHERE update_id = ?", (update_id,))
+            db.commit()
+            return job_id
+
+    def _finish_job(self, job_id):
+        with self._lock:
+            db = self._connect()
+            db.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+            db.commit()
+
+    def _take_unfinished(self, table, columns, order):
+        # Каждый перезапуск считается попыткой: записи, на которых процесс падает, не повторяются бесконечно
+        with self._lock:
+            db = self._connect()
+            created = "received" if table == "updates" else "created"
+            dropped = db.execute(
+                f"DELETE FROM {table} WHERE attempts >= ? OR {created} < ?",
+                (self.max_attempts, time.time() - self.max_age),
+            ).rowcount
+            db.execute(f"UPDATE {table} SET attempts = attempts + 1")
+            rows = db.execute(f"SELECT {columns} FROM {table} ORDER BY {order}").fetchall()
+            db.commit()
+        self.dropped += dropped
+        if dropped:
+            logger.warning(f"Отброшено устаревших или неудачных записей ({table}): {dropped}")
+        return rows
+
+    def _append_history(self, chat_id, request, response):
+        with self._lock:
+            db = self._connect()
+            db.execute(
+                "INSERT INTO chat_history (chat_id, request, response, created) VALUES (?, ?, ?, ?)",
+                (chat_id, request[:self.history_max_chars], response[:self.history_max_chars], time.time()),
+            )
+            db.execute(
+                "DELETE FROM chat_history WHERE chat_id = ? AND id NOT IN ("
+                "SELECT id FROM chat_history WHERE chat_id = ? ORDER BY id DESC LIMIT ?)",
+                (chat_id, chat_id, self.history_limit),
+            )
+            db.commit()
+
+    def _history(self, chat_id, limit):
+        with self._lock:
+            rows = self._connect().execute(
+                "SELECT request, response, created FROM chat_history WHERE chat_id = ? ORDER BY id DESC LIMIT ?",
+                (chat_id, limit),
+            ).fetchall()
+        return rows[::-1]
+
+    async def add_update(self, update_data):
+        """Сохраняет обновление. Возвращает False, если оно уже было принято раньше."""
+        return await asyncio.to_thread(self._add_update, update_data)
+
+    async def remove_update(self, update_id, forget=False):
+        """Удаляет обработанное обновление. forget=True — обновление не принято, повторная доставка будет обработана."""
+        await asyncio.to_thread(self._remove_update, update_id, forget)
+
+    async def start_job(self, update_id, chat_id, kind, payload):
+        """Записывает задание генерации вместо обновления, из которого оно получено. Возвращает id задания."""
+        return await asyncio.to_thread(self._start_job, update_id, chat_id, kind, payload)
+
+    async def finish_job(self, job_id):
+        await asyncio.to_thread(self._finish_job, job_id)
+
+    async def pending_updates(self):
+        rows = await asyncio.to_thread(self._take_unfinished, "updates", "payload", "update_id")
+        self.resumed_updates += len(rows)
+        return [json.loads(payload) for payload, in rows]
+
+    async def unfinished_jobs(self):
+        """[(id задания, chat_id, вид, параметры)] в порядке создания."""
+        rows = await asyncio.to_thread(self._take_unfinished, "jobs", "id, chat_id, kind, payload", "id")
+        self.resumed_jobs += len(rows)
+        return [(job_id, chat_id, kind, json.loads(payload)) for job_id, chat_id, kind, payload in rows]
+
+    async def append_history(self, chat_id, request, response):
+        try:
+            await asyncio.to_thread(self._append_history, chat_id, request, response)
+        except Exception as e:
+            logger.error(f"Ошибка записи истории чата {chat_id}: {e}")
+
+    async def history(self, chat_id, limit=None):
+        """[(запрос, пост, время)] от старых к новым."""
+        return await asyncio.to_thread(self._history, chat_id, limit or self.history_limit)
+
+    def stats(self):
+        return {
+            "resumed_updates": self.resumed_updates,
+            "resumed_jobs": self.resumed_jobs,
+            "dropped": self.dropped,
+        }
+
+state_store = StateStore()
+
+# Обработчики сообщений бота
+active_generations = {}
+
+async def _keep_typing(bot, chat_id):
+    while True:
+        try:
+            await telegram_sender.submit(
+                chat_id, lambda: bot.send_chat_action(chat_id=chat_id, action="typing"), per_chat=False
+            )
+        except Exception as e:
+            logger.warning(f"Не удалось отправить статус набора текста: {e}")
+        await asyncio.sleep(5)
+
+def cancel_generation(chat_id):
+    """Отменяет генерацию, запущенную для чата. Возвращает True, если было что отменять."""
+    task = active_generations.get(chat_id)
+    if task is None or task.done():
+        return False
+    task.cancel()
+    return True
+
+async def run_chat_job(bot, chat_id, job):
+    """Выполняет генерацию для чата с индикатором набора текста; /cancel отменяет её."""
+    typing_task = asyncio.create_task(_keep_typing(bot, chat_id))
+    generation = asyncio.create_task(job)
+    active_generations[chat_id] = generation
+    try:
+        # asyncio.wait не пробрасывает отмену генерации в обработчик
+        await asyncio.wait({generation})
+    except asyncio.CancelledError:
+        generation.cancel()
+        raise
+    finally:
+        typing_task.cancel()
+        if active_generations.get(chat_id) is generation:
+            del active_generations[chat_id]
+
+    if not generation.cancelled() and generation.exception() is not None:
+        logger.error(f"Ошибка отправки поста: {generation.exception()}")
+
+async def authorize(update: Update, command):
+    """Профиль агента, если ему доступна команда и не исчерпана квота; иначе отвечает отказом и возвращает None."""
+    user = update.effective_user
+    profile = agent_registry.get(user)
+    if not profile.allows(command):
+        await reply_text(update, "Эта команда вам недоступна.")
+        return None
+    if command in ("post", "voice"):
+        refusal = agent_registry.consume(user.id if user else update.effective_chat.id, profile)
+        if refusal:
+            await reply_text(update, refusal)
+            return None
+    return profile
+
+def _job_coroutine(bot, chat_id, kind, payload):
+    if kind == "voice":
+        return _voice_post(bot, chat_id, payload["file_id"], payload["format"], payload.get("signature", ""))
+    return deliver_post(bot, chat_id, payload["text"], payload.get("signature", ""))
+
+async def run_stored_job(bot, job_id, chat_id, kind, payload):
+    """Выполняет сохранённое задание генерации. Если процесс останавливается посреди работы,
+    задание остаётся в state_store и продолжается после перезапуска."""
+    await run_chat_job(bot, chat_id, _job_coroutine(bot, chat_id, kind, payload))
+    await state_store.finish_job(job_id)
+
+async def start_job(update: Update, bot, kind, payload):
+    chat_id = update.effective_chat.id
+    job_id = await state_store.start_job(update.update_id, chat_id, kind, payload)
+    await run_stored_job(bot, job_id, chat_id, kind, payload)
+
+async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    profile = await authorize(update, "post")
+    if profile is None:
+        return
+    await start_job(update, context.bot, "post", {"text": update.effective_message.text, "signature": profile.signature})
+
+AUDIO_MIME_FORMATS = {"audio/ogg": "ogg", "audio/mpeg": "mp3", "audio/mp4": "m4a", "audio/x-wav": "wav", "audio/wav": "wav"}
+
+async def _voice_post(bot, chat_id, file_id, source_format, signature=""):
+    try:
+        telegram_file = await bot.get_file(file_id)
+        audio = bytes(await telegram_file.download_as_bytearray())
+        transcript = await voice_pipeline.transcribe(audio, source_format)
+    except Exception as e:
+        logger.error(f"Ошибка при обработке голосового сообщения: {e!r}")
+        transcript = None
+    if not transcript:
+        await telegram_sender.send_message(bot, chat_id, "Не удалось обработать голосовое сообщение.")
+        return
+    await deliver_post(bot, chat_id, transcript, signature)
+
+async def handle_voice_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
+    message = update.effective_message
+    voice = message.voice or message.audio
+    if voice.file_size and voice.file_size > VOICE_MAX_BYTES:
+        await reply_text(update, "Голосовое сообщение слишком длинное.")
+        return
+    profile = await authorize(update, "voice")
+    if profile is None:
+        return
+    source_format = "ogg" if message.voice else AUDIO_MIME_FORMATS.get(voice.mime_type, "mp3")
+    await start_job(update, context.bot, "voice", {
+        "file_id": voice.file_id, "format": source_format, "signature": profile.signature,
+    })
+
+async def cancel_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Сама отмена выполняется сразу при получении вебхука, здесь только ответ пользователю
+    await reply_text(update, "Генерация остановлена.")
+
+async def history_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/history — последние запросы постов в этом чате."""
+    if await authorize(update, "history") is None:
+        return
+    rows = await state_store.history(update.effective_chat.id, limit=10)
+    if not rows:
+        await reply_text(update, "В этом чате ещё не было запросов.")
+        return
+    lines = [
+        f"{time.strftime('%d.%m %H:%M', time.localtime(created))} — {request[:200]}"
+        for request, _, created in rows
+    ]
+    await reply_text(update, "Последние запросы:\n" + "\n".join(lines))
+
+async def resume_pending_work(bot):
+    """После перезапуска ставит в очереди чатов незавершённые генерации и обновления, принятые до остановки."""
+    jobs = await state_store.unfinished_jobs()
+    updates = await state_store.pending_updates()
+    # Обработчики очереди ещё не запущены: всё принятое до остановки встаёт перед пришедшим после старта,
+    # генерации — перед необработанными обновлениями. Если очередь заполнена, запись остаётся в базе до следующего запуска
+    for update_data in reversed(updates):
+        update_dispatcher.submit(update_data, first=True)
+    for job_id, chat_id, kind, payload in reversed(jobs):
+        update_dispatcher.submit_job(
+            chat_id, partial(run_stored_job, bot, job_id, chat_id, kind, payload), f"задания {job_id}", first=True
+        )
+    if jobs or updates:
+        logger.info(f"После перезапуска продолжено генераций: {len(jobs)}, обновлений: {len(updates)}")
+
+async def start_background_work(bot):
+    """Фоновый запуск: снимок инвентаря, продолжение незавершённой работы, обработчики очереди, обновление данных."""
+    # Снимок поднимается первым: продолженные запросы должны видеть инвентарь
+    await restore_inventory()
+    try:
+        await resume_pending_work(bot)
+    except Exception as e:
+        logger.error(f"Не удалось продолжить незавершённую работу: {e}")
+    update_dispatcher.start()
+    await refresh_scheduler()
+
+# Очередь входящих обновлений
+def _update_chat_id(update_data):
+    for field in ("message", "edited_message", "channel_post", "edited_channel_post"):
+        chat = update_data.get(field, {}).get("chat")
+        if chat:
+            return chat.get("id")
+    callback_message = update_data.get("callback_query", {}).get("message")
+    if callback_message:
+        return callback_message.get("chat", {}).get("id")
+    return None
+
+class UpdateDispatcher:
+    """Ограниченная очередь обновлений с пулом обработчиков.
+
+    Обновления одного чата обрабатываются строго по порядку одним обработчиком,
+    разные чаты обрабатываются параллельно. В ту же очередь чата ставятся задания,
+    продолженные после перезапуска.
+    """
+
+    def __init__(self, process, workers=UPDATE_WORKERS, maxsize=UPDATE_QUEUE_SIZE):
+        self.process = process
+        self.workers = workers
+        self.maxsize = maxsize
+        self.size = 0
+        self._ready = asyncio.Queue()
+        self._pending = {}
+        self._tasks = []
+        self.received = 0
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.max_depth = 0
+        self.wait_time_total = 0.0
+
+    def submit(self, update_data, first=False):
+        """Ставит обновление в очередь. first=True — в начало очереди чата (принятое до перезапуска).
+        Возвращает False, если очередь переполнена."""
+        chat_id = _update_chat_id(update_data)
+        key = chat_id if chat_id is not None else ("update", update_data.get("update_id"))
+        return self._put(key, lambda: self.process(update_data), f"обновления {update_data.get('update_id')}", first)
+
+    def submit_job(self, chat_id, job, description, first=False):
+        """Ставит в очередь чата job — функцию без аргументов, возвращающую корутину."""
+        return self._put(chat_id, job, description, first)
+
+    def _put(self, key, run, description, first):
+        if self.size >= self.maxsize:
+            self.rejected += 1
+            if self.rejected % 100 == 1:
+                logger.warning(f"Очередь обновлений переполнена ({self.size}), отклонено всего: {self.rejected}")
+            return False
+        self.received += 1
+        self.size += 1
+        self.max_depth = max(self.max_depth, self.size)
+        entry = (run, description, time.monotonic())
+        pending = self._pending.get(key)
+        if pending is None:
+            self._pending[key] = deque([entry])
+            self._ready.put_nowait(key)
+        elif first:
+            pending.appendleft(entry)
+        else:
+            pending.append(entry)
+        return True
+
+    async def _worker(self):
+        while True:
+            key = await self._ready.get()
+            pending = self._pending[key]
+            while pending:
+                run, description, enqueued_at = pending[0]
+                waited = time.monotonic() - enqueued_at
+                self.wait_time_total += waited
+                update_wait_seconds.observe(waited)
+                started = time.perf_counter()
+                try:
+                    await run()
+                    self.processed += 1
+                    update_process_seconds.observe(time.perf_counter() - started, result="ok")
+                except Exception as e:
+                    self.failed += 1
+                    update_process_seconds.observe(time.perf_counter() - started, result="error")
+                    logger.error(f"Ошибка обработки {description}: {e}", exc_info=True)
+                finally:
+                    pending.popleft()
+                    self.size -= 1
+            del self._pending[key]
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def stats(self):
+        return {
+            "depth": self.size,
+            "max_depth": self.max_depth,
+            "received": self.received,
+            "processed": self.processed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "avg_wait_seconds": self.wait_time_total / self.processed if self.processed else 0.0,
+        }
+
+async def process_update_data(update_data):
+    update = Update.de_json(update_data, application.bot)
+    try:
+        await application.process_update(update)
+    except Exception:
+        # Обновление, на котором падает обработка, не повторяется после перезапуска
+        await state_store.remove_update(update.update_id)
+        raise
+    await state_store.remove_update(update.update_id)
+
+# Вебхуковый маршрут: быстрая проверка и постановка в очередь, обработка идёт в фоне
 async def webhook_handler(request):
+    started = time.perf_counter()
+    response = await _accept_webhook(request)
+    webhook_seconds.observe(time.perf_counter() - started, status=response.status)
+    return response
+
+async def _accept_webhook(request):
+    if WEBHOOK_SECRET_TOKEN and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET_TOKEN:
+        return web.Response(status=403)
+    if request.content_length is not None and request.content_length > WEBHOOK_MAX_BODY_SIZE:
+        return web.Response(status=413)
     try:
-        logger.info("Получен запрос на маршрут /webhook")
-        update_data = await request.json()
-        logger.info(f"Полученные данные: {update_data}")
-        update = Update.de_json(update_data, application.bot)
-        await application.update_queue.put(update)
+        update_data = json.loads(await request.read())
+    except ValueError:
+        logger.warning("Получен вебхук с некорректным JSON")
+        return web.Response(status=400)
+    if not isinstance(update_data, dict) or "update_id" not in update_data:
+        return web.Response(status=400)
+    logger.debug(f"Полученные данные: {update_data}")
+    message = update_data.get("message") or {}
+    if (message.get("text") or "").split("@")[0].strip() == "/cancel":
+        # Отмена не должна ждать в очереди чата, пока закончится та самая генерация
+        cancel_generation(message.get("chat", {}).get("id"))
+    # Обновление сохраняется до ответа Telegram, чтобы пережить перезапуск
+    if not await state_store.add_update(update_data):
+        # Повторная доставка уже принятого обновления: оно в очереди или будет продолжено после перезапуска
         return web.Response(text="OK")
-    except Exception as e:
-        logger.error(f"Ошибка обработки вебхука: {e}", exc_info=True)
-        return web.Response(status=500)
+    if not update_dispatcher.submit(update_data):
+        await state_store.remove_update(update_data["update_id"], forget=True)
+        # Telegram повторит доставку позже
+        return web.Response(status=503, headers={"Retry-After": "5"})
+    return web.Response(text="OK")
 
-# Основной процесс
-async def main():
-    global application
+# Метрики для Prometheus
+async def metrics_handler(request):
+    if METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+        return web.Response(status=403)
+    return web.Response(
+        body=render_metrics().encode("utf-8"), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+    )
 
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
-    await application.initialize()
-    await application.start()
+# Сборка приложения
+def build_application(token=None, base_url=None):
+    """Приложение python-telegram-bot с обработчиками. base_url позволяет направить Bot API на локальную заглушку."""
+    # Клиент Telegram (httpx) держит собственный пул соединений на всё время работы
+    builder = (
+        Application.builder()
+        .token(token or TELEGRAM_BOT_TOKEN)
+        .connection_pool_size(TELEGRAM_POOL_SIZE)
+        .pool_timeout(HTTP_CONNECT_TIMEOUT)
+        .connect_timeout(HTTP_CONNECT_TIMEOUT)
+        .read_timeout(HTTP_READ_TIMEOUT)
+    )
+    if base_url:
+        builder = builder.base_url(base_url)
+    result = builder.build()
+    result.add_handler(CommandHandler("refresh", refresh_command))
+    result.add_handler(CommandHandler("cancel", cancel_command))
+    result.add_handler(CommandHandler("batch", batch_command))
+    result.add_handler(CommandHandler("history", history_command))
+    # Только новые сообщения: правки и посты каналов не должны списывать квоту и запускать генерацию
+    result.add_handler(MessageHandler(filters.UpdateType.MESSAGE & filters.TEXT & ~filters.COMMAND, handle_text_message))
+    result.add_handler(MessageHandler(filters.UpdateType.MESSAGE & (filters.VOICE | filters.AUDIO), handle_voice_message))
+    return result
 
+def create_web_app():
     # Настройка маршрутов веб-сервера
     app = web.Application()
     app.router.add_get("/", root_handler)  # Корневой маршрут
     app.router.add_post("/webhook", webhook_handler)  # Вебхук
+    app.router.add_post("/refresh", refresh_handler)  # Обновление данных по запросу
+    app.router.add_get("/metrics", metrics_handler)  # Метрики для Prometheus
+    return app
+
+# Основной процесс
+async def main():
+    global application, update_dispatcher
+    refresh_task = None
+
+    application = build_application()
+    await application.initialize()
+    await application.start()
+
+    # Yandex.Disk и OpenAI ходят через общую сессию aiohttp
+    openai.aiosession.set(get_http_session())
+
+    # Обработчики очереди запускает start_background_work, вебхук принимает обновления сразу
+    update_dispatcher = UpdateDispatcher(process_update_data)
+    if WEBHOOK_URL and WEBHOOK_SECRET_TOKEN:
+        try:
+            await application.bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET_TOKEN)
+        except Exception as e:
+            logger.error(f"Не удалось зарегистрировать вебхук: {e}")
+
+    app = create_web_app()
 
     try:
         runner = web.AppRunner(app)
@@ -122,15 +2917,20 @@ async def main():
         await site.start()
         logger.info(f"Сервер запущен и слушает порт {PORT}")
 
-        # Загрузка данных
-        await download_yandex_file()
+        # Загрузка данных идёт в фоне, сервер отвечает сразу
+        refresh_task = asyncio.create_task(start_background_work(application.bot))
 
         await shutdown_event.wait()
     except Exception as e:
         logger.error(f"Ошибка в основном цикле: {e}")
     finally:
+        if refresh_task is not None:
+            refresh_task.cancel()
+        await update_dispatcher.stop()
+        await telegram_sender.stop()
         await application.stop()
         await runner.cleanup()
+        await close_http_session()
         logger.info("Приложение завершено корректно")
 
 # Для управления остановкой
@@ -139,6 +2939,9 @@ def signal_handler(*_):
 
 if __name__ == "__main__":
     try:
-        asyncio.run(main())
+        if sys.argv[1:2] == ["batch"]:
+            asyncio.run(batch_cli(sys.argv[2:]))
+        else:
+            asyncio.run(main())
     except Exception as e:
         logger.error(f"Критическая ошибка: {e}", exc_info=True)
\ No newline at end of file
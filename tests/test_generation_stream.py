@@ -0,0 +1,78 @@
+import asyncio
+from contextlib import aclosing
+
+import openai
+
+import bench
+import main
+
+
+def run_with_openai(scenario):
+    """Запускает scenario(service, calls) против заглушки OpenAI. calls — число запросов к ней."""
+    calls = {"completions": 0}
+    ((method, path, handler),) = bench.fake_openai_routes(bench.FakeBehaviour(), chunk_interval=0.005)
+
+    async def counted(request):
+        calls["completions"] += 1
+        return await handler(request)
+
+    async def run():
+        runner, base_url = await bench.start_stub_server([(method, path, counted)])
+        openai.api_key = "test"
+        openai.api_base = f"{base_url}/v1"
+        openai.aiosession.set(main.get_http_session())
+        try:
+            service = main.GenerationService(requests_per_minute=10**6, tokens_per_minute=10**9)
+            return await scenario(service, calls)
+        finally:
+            await main.close_http_session()
+            await runner.cleanup()
+
+    return asyncio.run(run())
+
+
+async def read(service, text, limit=None):
+    received = []
+    async with aclosing(service.stream(text)) as fragments:
+        async for fragment in fragments:
+            received.append(fragment)
+            if limit and len(received) >= limit:
+                break
+    return "".join(received)
+
+
+def test_identical_streams_share_one_request():
+    async def scenario(service, calls):
+        first, second, partial = await asyncio.gather(
+            read(service, "пост"), read(service, "пост"), read(service, "пост", limit=2)
+        )
+        assert first == second == bench.FAKE_POST
+        assert bench.FAKE_POST.startswith(partial)
+        assert calls["completions"] == 1
+        assert service.stats()["deduplicated"] == 2
+
+    run_with_openai(scenario)
+
+
+def test_stream_joins_inflight_completion():
+    async def scenario(service, calls):
+        completion = asyncio.create_task(service.generate("пост"))
+        await asyncio.sleep(0)
+        streamed = await read(service, "пост")
+        assert streamed == await completion == bench.FAKE_POST
+        assert calls["completions"] == 1
+
+    run_with_openai(scenario)
+
+
+def test_upstream_is_cancelled_when_last_reader_leaves():
+    async def scenario(service, calls):
+        reader = asyncio.create_task(read(service, "пост"))
+        await asyncio.sleep(0.02)
+        reader.cancel()
+        await asyncio.gather(reader, return_exceptions=True)
+        await asyncio.sleep(0)
+        assert service.stats()["cancelled"] == 1
+        assert service.stats()["in_flight"] == 0
+
+    run_with_openai(scenario)
@@ -0,0 +1,113 @@
+import pandas as pd
+import pytest
+
+import bench
+import main
+
+ROWS = 200
+
+
+def write(frame, path):
+    frame.to_csv(path, sep=";", index=False)
+    return str(path)
+
+
+def edit(frame):
+    """Снижение цены, продажа, новая акция, одна удалённая и одна новая квартира."""
+    frame = frame.copy()
+    frame.loc[3, "Цена со скидкой"] -= 150_000
+    frame.loc[5, "Продано"] = True
+    frame.loc[7, "Акция"] = "Скидка 10%"
+    extra = bench.make_synthetic_frame(1, seed=3)
+    extra["Номер квартиры"] = ROWS + 1
+    extra["Акция"] = "Ипотека 0.1%"
+    return pd.concat([frame.drop(index=[0]), extra], ignore_index=True)
+
+
+def assert_same_inventory(actual, expected):
+    pd.testing.assert_frame_equal(
+        actual.df.astype(object), expected.df.astype(object), check_dtype=False, check_categorical=False
+    )
+    for filters in ({"rooms": 2}, {"city": "Краснодар", "price_max": 8_000_000}, {"complex_name": bench.COMPLEXES[0]}):
+        assert list(actual.find_positions(**filters)) == list(expected.find_positions(**filters))
+
+
+@pytest.fixture
+def frame():
+    frame = bench.make_synthetic_frame(ROWS)
+    frame["Продано"] = False
+    frame["Акция"] = ""
+    return frame
+
+
+def test_delta_matches_full_reload(tmp_path, frame):
+    path = write(frame, tmp_path / "data.csv")
+    previous = main.load_inventory(path)
+    write(edit(frame), path)
+    updated, changes = main.load_inventory_delta(previous, path)
+    assert changes is not None
+    assert_same_inventory(updated, main.load_inventory(path))
+
+
+def test_delta_from_restored_snapshot(tmp_path, frame):
+    path = write(frame, tmp_path / "data.csv")
+    main.save_inventory_snapshot(main.load_inventory(path), path, str(tmp_path / "snapshot"))
+    restored = main.load_inventory_snapshot(str(tmp_path / "snapshot"))
+    assert main.attach_snapshot_source(restored, path)
+    write(edit(frame), path)
+    updated, changes = main.load_inventory_delta(restored, path)
+    assert changes is not None
+    assert_same_inventory(updated, main.load_inventory(path))
+
+
+def test_snapshot_source_is_not_attached_to_other_file(tmp_path, frame):
+    path = write(frame, tmp_path / "data.csv")
+    main.save_inventory_snapshot(main.load_inventory(path), path, str(tmp_path / "snapshot"))
+    write(edit(frame), path)
+    restored = main.load_inventory_snapshot(str(tmp_path / "snapshot"))
+    assert not main.attach_snapshot_source(restored, path)
+    _, changes = main.load_inventory_delta(restored, path)
+    assert changes is None
+
+
+def test_change_set_contents(tmp_path, frame):
+    path = write(frame, tmp_path / "data.csv")
+    previous = main.load_inventory(path)
+    write(edit(frame), path)
+    _, changes = main.load_inventory_delta(previous, path)
+
+    assert len(changes.updated) == len(changes.previous) == 3
+    assert list(changes.inserted["Номер квартиры"]) == [ROWS + 1]
+    assert list(changes.deleted["Номер квартиры"]) == [1]
+    drops = changes.price_drops
+    assert list(drops["Номер квартиры"]) == [4]
+    assert drops["Старая цена"].iloc[0] - main.Inventory._effective_prices(drops)[0] == 150_000
+    assert list(changes.newly_sold["Номер квартиры"]) == [6]
+    assert sorted(changes.new_promotions["Номер квартиры"]) == [8, ROWS + 1]
+
+
+def test_unchanged_file_gives_empty_change_set(tmp_path, frame):
+    path = write(frame, tmp_path / "data.csv")
+    previous = main.load_inventory(path)
+    updated, changes = main.load_inventory_delta(previous, path)
+    assert changes is not None and not changes
+    assert_same_inventory(updated, previous)
+
+
+def test_mass_change_falls_back_to_full_reload(tmp_path, frame):
+    path = write(frame, tmp_path / "data.csv")
+    previous = main.load_inventory(path)
+    frame["Цена со скидкой"] -= 1_000
+    write(frame, path)
+    updated, changes = main.load_inventory_delta(previous, path)
+    assert changes is None
+    assert_same_inventory(updated, main.load_inventory(path))
+
+
+def test_header_change_falls_back_to_full_reload(tmp_path, frame):
+    path = write(frame, tmp_path / "data.csv")
+    previous = main.load_inventory(path)
+    write(frame.drop(columns=["Путь до картинок"]), path)
+    updated, changes = main.load_inventory_delta(previous, path)
+    assert changes is None
+    assert_same_inventory(updated, main.load_inventory(path))
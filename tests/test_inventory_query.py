@@ -0,0 +1,55 @@
+import pandas as pd
+import pytest
+
+import main
+
+
+@pytest.fixture(scope="module")
+def source():
+    df = pd.DataFrame({
+        "Жилой комплекс Раздел 1": ["ЖК Звёздный", "ЖК Тест 1", "ЖК Тест 12"],
+        "Город": ["Королёв", "Краснодар", "Ростов-на-Дону"],
+        "Цена": [5_000_000, 6_000_000, 7_000_000],
+        "Комнат": ["2", "1", "3"],
+    })
+    return main.Inventory(main.prepare_inventory_frame(df))
+
+
+@pytest.mark.parametrize("text", ["Пост про ЖК Звёздный в Королёве", "пост про жк звездный в королеве"])
+def test_yo_spelling_matches_index(source, text):
+    query = main.parse_inventory_query(text, source)
+    assert query.complexes == ["жк звездный"]
+    assert query.city == "королев"
+
+
+def test_complex_name_is_not_matched_inside_longer_name(source):
+    assert main.parse_inventory_query("Пост про ЖК Тест 12", source).complexes == ["жк тест 12"]
+
+
+@pytest.mark.parametrize("text, price_min, price_max", [
+    ("2-комнатная до 6 млн", None, 6_000_000),
+    ("до 6,5 млн", None, 6_500_000),
+    ("бюджет 8 500 000 руб", None, 8_500_000),
+    ("от 3 млн до 5 млн", 3_000_000, 5_000_000),
+    ("до 900 тыс", None, 900_000),
+    ("квартира до 6", None, 6_000_000),
+    ("до 10 этажа, до 8 млн", None, 8_000_000),
+])
+def test_budget(source, text, price_min, price_max):
+    query = main.parse_inventory_query(text, source)
+    assert (query.price_min, query.price_max) == (price_min, price_max)
+
+
+@pytest.mark.parametrize("text", [
+    "сдача до 2026 года",
+    "площадью от 40 м2",
+    "площадью от 40 м²",
+    "до 10 этажа",
+    "от 2 комнат",
+    "от 2-комнатной",
+    "до 15 минут до моря",
+])
+def test_numbers_that_are_not_prices(source, text):
+    query = main.parse_inventory_query(text, source)
+    assert query.price_min is None
+    assert query.price_max is None
@@ -0,0 +1,125 @@
+import asyncio
+
+import pytest
+
+import main
+
+
+def make_update(update_id, chat_id, text="пост"):
+    return {"update_id": update_id, "message": {"message_id": update_id, "chat": {"id": chat_id}, "text": text}}
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / "state.sqlite3")
+
+
+def test_redelivery_is_ignored_after_job_start(db_path):
+    async def run():
+        store = main.StateStore(db_path)
+        assert await store.add_update(make_update(1, 10))
+        assert not await store.add_update(make_update(1, 10))
+        await store.start_job(1, 10, "post", {"text": "пост"})
+        assert not await store.add_update(make_update(1, 10))
+        await store.remove_update(1)
+        assert not await store.add_update(make_update(1, 10))
+
+    asyncio.run(run())
+
+
+def test_rejected_update_is_accepted_again(db_path):
+    async def run():
+        store = main.StateStore(db_path)
+        assert await store.add_update(make_update(1, 10))
+        await store.remove_update(1, forget=True)
+        assert await store.add_update(make_update(1, 10))
+
+    asyncio.run(run())
+
+
+def test_unfinished_work_survives_restart(db_path):
+    async def run():
+        store = main.StateStore(db_path)
+        for update_id in (1, 2, 3):
+            await store.add_update(make_update(update_id, 10))
+        job_id = await store.start_job(1, 10, "post", {"text": "первый"})
+        await store.remove_update(3)
+
+        restarted = main.StateStore(db_path)
+        assert await restarted.unfinished_jobs() == [(job_id, 10, "post", {"text": "первый"})]
+        assert [update["update_id"] for update in await restarted.pending_updates()] == [2]
+        await restarted.finish_job(job_id)
+        assert await main.StateStore(db_path).unfinished_jobs() == []
+
+    asyncio.run(run())
+
+
+def test_records_are_dropped_after_max_attempts(db_path):
+    async def run():
+        store = main.StateStore(db_path, max_attempts=2)
+        await store.add_update(make_update(1, 10))
+        await store.start_job(1, 10, "post", {"text": "пост"})
+        # Каждый перезапуск, на котором задание не завершилось, считается попыткой
+        assert len(await store.unfinished_jobs()) == 1
+        assert len(await store.unfinished_jobs()) == 1
+        assert await store.unfinished_jobs() == []
+        assert store.stats()["dropped"] == 1
+
+    asyncio.run(run())
+
+
+def test_old_records_are_dropped(db_path):
+    async def run():
+        store = main.StateStore(db_path, max_age=-1)
+        await store.add_update(make_update(1, 10))
+        assert await store.pending_updates() == []
+        assert store.stats()["dropped"] == 1
+
+    asyncio.run(run())
+
+
+def test_history_is_trimmed_per_chat(db_path):
+    async def run():
+        store = main.StateStore(db_path, history_limit=3, history_max_chars=10)
+        for i in range(5):
+            await store.append_history(10, f"запрос {i}", f"пост {i} " + "x" * 20)
+        await store.append_history(20, "другой чат", "пост")
+        rows = await store.history(10)
+        assert [request for request, _, _ in rows] == ["запрос 2", "запрос 3", "запрос 4"]
+        assert all(len(response) == 10 for _, response, _ in rows)
+        assert len(await store.history(20)) == 1
+
+    asyncio.run(run())
+
+
+def test_resumed_work_runs_before_new_updates(db_path, monkeypatch):
+    log = []
+
+    async def process(update_data):
+        log.append(update_data["update_id"])
+
+    async def run_stored_job(bot, job_id, chat_id, kind, payload):
+        log.append(payload["text"])
+
+    async def run():
+        store = main.StateStore(db_path)
+        await store.add_update(make_update(1, 10))
+        await store.start_job(1, 10, "post", {"text": "продолженное задание"})
+        await store.add_update(make_update(2, 10))
+
+        dispatcher = main.UpdateDispatcher(process, workers=2)
+        monkeypatch.setattr(main, "state_store", main.StateStore(db_path))
+        monkeypatch.setattr(main, "update_dispatcher", dispatcher)
+        monkeypatch.setattr(main, "run_stored_job", run_stored_job)
+        # Обновление, пришедшее через вебхук, пока бот поднимался
+        dispatcher.submit(make_update(3, 10))
+        await main.resume_pending_work(bot=None)
+        dispatcher.start()
+        try:
+            while dispatcher.size:
+                await asyncio.sleep(0.01)
+        finally:
+            await dispatcher.stop()
+
+    asyncio.run(run())
+    assert log == ["продолженное задание", 2, 3]
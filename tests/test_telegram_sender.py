@@ -0,0 +1,86 @@
+import asyncio
+
+from telegram.error import RetryAfter
+
+import main
+
+
+def make_sender(**kwargs):
+    options = dict(global_rate=1000, chat_interval=0.02, group_interval=0.02, concurrency=4, max_retries=2)
+    options.update(kwargs)
+    return main.TelegramSender(**options)
+
+
+def call(log, name, delay=0.0, fail_first=None):
+    """Вызов Bot API для очереди: записывает имя в log. fail_first — исключение для первой попытки."""
+    attempts = []
+
+    async def request():
+        attempts.append(name)
+        if fail_first is not None and len(attempts) == 1:
+            raise fail_first
+        await asyncio.sleep(delay)
+        log.append(name)
+        return name
+
+    return request
+
+
+def run(scenario):
+    async def wrapper():
+        sender = make_sender()
+        try:
+            return await scenario(sender)
+        finally:
+            await sender.stop()
+
+    return asyncio.run(wrapper())
+
+
+def test_interactive_messages_go_before_batch():
+    async def scenario(sender):
+        log = []
+        sender.concurrency = 1
+        futures = [sender.enqueue(-100 - i, call(log, f"batch {i}"), main.PRIORITY_BATCH) for i in range(3)]
+        futures.append(sender.enqueue(1, call(log, "interactive")))
+        await asyncio.gather(*futures)
+        return log
+
+    assert run(scenario) == ["interactive", "batch 0", "batch 1", "batch 2"]
+
+
+def test_messages_of_one_chat_keep_order():
+    async def scenario(sender):
+        log = []
+        futures = [sender.enqueue(1, call(log, i, delay=0.01 * (5 - i))) for i in range(5)]
+        await asyncio.gather(*futures)
+        return log
+
+    assert run(scenario) == [0, 1, 2, 3, 4]
+
+
+def test_retry_after_requeues_in_place():
+    async def scenario(sender):
+        log = []
+        first = sender.enqueue(1, call(log, "first", fail_first=RetryAfter(0.05)))
+        second = sender.enqueue(1, call(log, "second"))
+        other = sender.enqueue(2, call(log, "other chat"))
+        assert await asyncio.gather(first, second, other) == ["first", "second", "other chat"]
+        return log, sender.stats()
+
+    log, stats = run(scenario)
+    assert log == ["other chat", "first", "second"]
+    assert stats["retries"] == 1
+    assert stats["failed"] == 0
+
+
+def test_chat_action_does_not_take_chat_slot():
+    async def scenario(sender):
+        sender.chat_interval = 10
+        log = []
+        await sender.submit(1, call(log, "typing"), per_chat=False)
+        await asyncio.wait_for(sender.submit(1, call(log, "message")), 1)
+        await sender.submit(1, call(log, "typing again"), per_chat=False)
+        return log
+
+    assert run(scenario) == ["typing", "message", "typing again"]
@@ -0,0 +1,81 @@
+import asyncio
+import shutil
+import subprocess
+
+import pytest
+
+import main
+
+needs_ffmpeg = pytest.mark.skipif(shutil.which(main.FFMPEG_BINARY) is None, reason="ffmpeg не установлен")
+
+
+@pytest.fixture(scope="module")
+def voice_ogg():
+    # Секунда тона в ogg/opus, как голосовые сообщения Telegram
+    return subprocess.run(
+        [main.FFMPEG_BINARY, "-hide_banner", "-loglevel", "error", "-f", "lavfi", "-i", "sine=frequency=440:duration=1",
+         "-c:a", "libopus", "-f", "ogg", "pipe:1"],
+        check=True, capture_output=True,
+    ).stdout
+
+
+class RecordingTranscriber(main.StubTranscriber):
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.received = []
+        self.active = 0
+        self.max_active = 0
+
+    async def transcribe(self, audio, audio_format):
+        self.received.append((audio[:4], audio_format))
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            await asyncio.sleep(self.delay)
+            return await super().transcribe(audio, audio_format)
+        finally:
+            self.active -= 1
+
+
+@needs_ffmpeg
+def test_stub_transcriber_gets_transcoded_wav(voice_ogg):
+    transcriber = RecordingTranscriber()
+    pipeline = main.VoicePipeline(transcriber)
+    text = asyncio.run(pipeline.transcribe(voice_ogg, "ogg"))
+    assert text == "Голосовое сообщение успешно преобразовано."
+    assert transcriber.received == [(b"RIFF", "wav")]
+    assert pipeline.stats()["jobs"] == 1
+    assert pipeline.stats()["failures"] == 0
+
+
+def test_matching_format_is_not_transcoded():
+    transcriber = RecordingTranscriber()
+    pipeline = main.VoicePipeline(transcriber)
+    asyncio.run(pipeline.transcribe(b"RIFFdata", "wav"))
+    assert transcriber.received == [(b"RIFF", "wav")]
+
+
+@needs_ffmpeg
+def test_broken_audio_is_reported():
+    pipeline = main.VoicePipeline(main.StubTranscriber())
+    with pytest.raises(main.VoiceProcessingError):
+        asyncio.run(pipeline.transcribe(b"not an ogg file", "ogg"))
+    assert pipeline.stats()["failures"] == 1
+
+
+def test_timeout_is_counted():
+    pipeline = main.VoicePipeline(RecordingTranscriber(delay=1.0), timeout=0.05)
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(pipeline.transcribe(b"RIFFdata", "wav"))
+    assert pipeline.stats()["timeouts"] == 1
+
+
+def test_concurrency_is_limited():
+    transcriber = RecordingTranscriber(delay=0.05)
+    pipeline = main.VoicePipeline(transcriber, concurrency=2)
+
+    async def run():
+        return await asyncio.gather(*(pipeline.transcribe(b"RIFFdata", "wav") for _ in range(5)))
+
+    assert len(asyncio.run(run())) == 5
+    assert transcriber.max_active == 2
@@ -0,0 +1,97 @@
+import asyncio
+import hashlib
+import json
+
+import pytest
+
+import bench
+import main
+
+CONTENT = "Жилой комплекс Раздел 1;Цена\nЖК Тест 1;5000000\n".encode()
+
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "DATA_FILE", str(tmp_path / "data.csv"))
+    monkeypatch.setattr(main, "DATA_META_FILE", str(tmp_path / "data.csv.meta.json"))
+    monkeypatch.setattr(main, "YANDEX_FILE_URL", "https://disk.yandex.ru/d/test")
+    monkeypatch.setattr(main, "YANDEX_DISK_TOKEN", "test")
+    return tmp_path
+
+
+def fetch(monkeypatch, content=CONTENT, md5=None):
+    """Запускает fetch_yandex_file против заглушки. Возвращает (результат или исключение, вызовы по путям)."""
+    calls = {}
+
+    def counted(path, handler):
+        async def wrapper(request):
+            calls[path] = calls.get(path, 0) + 1
+            return await handler(request)
+        return wrapper
+
+    async def run():
+        routes = bench.fake_yandex_routes(bench.FakeBehaviour(), content, md5=md5)
+        runner, base_url = await bench.start_stub_server(
+            [(method, path, counted(path, handler)) for method, path, handler in routes]
+        )
+        monkeypatch.setattr(main, "YANDEX_API_URL", f"{base_url}/v1/disk")
+        try:
+            return await main.fetch_yandex_file()
+        except Exception as e:
+            return e
+        finally:
+            await main.close_http_session()
+            await runner.cleanup()
+
+    return asyncio.run(run()), calls
+
+
+def leftovers(data_dir):
+    return sorted(p.name for p in data_dir.iterdir() if p.name.endswith(".part"))
+
+
+def test_first_download_writes_file_and_meta(data_dir, monkeypatch):
+    updated, calls = fetch(monkeypatch)
+    assert updated is True
+    assert (data_dir / "data.csv").read_bytes() == CONTENT
+    meta = json.loads((data_dir / "data.csv.meta.json").read_text())
+    assert meta["md5"] == hashlib.md5(CONTENT).hexdigest()
+    assert calls["/yandex/file"] == 1
+    assert leftovers(data_dir) == []
+
+
+def test_unchanged_md5_skips_download(data_dir, monkeypatch):
+    fetch(monkeypatch)
+    updated, calls = fetch(monkeypatch)
+    assert updated is False
+    assert "/v1/disk/public/resources/download" not in calls
+    assert "/yandex/file" not in calls
+
+
+def test_not_modified_keeps_file(data_dir, monkeypatch):
+    fetch(monkeypatch)
+    # Метаданные сообщают о новой версии, но сам файл по ETag не изменился
+    updated, calls = fetch(monkeypatch, md5="0" * 32)
+    assert updated is False
+    assert calls["/yandex/file"] == 1
+    assert (data_dir / "data.csv").read_bytes() == CONTENT
+    assert leftovers(data_dir) == []
+
+
+def test_md5_mismatch_keeps_previous_file(data_dir, monkeypatch):
+    fetch(monkeypatch)
+    error, _ = fetch(monkeypatch, content=CONTENT + b"broken\n", md5="f" * 32)
+    assert isinstance(error, ValueError)
+    assert (data_dir / "data.csv").read_bytes() == CONTENT
+    assert json.loads((data_dir / "data.csv.meta.json").read_text())["md5"] == hashlib.md5(CONTENT).hexdigest()
+    assert leftovers(data_dir) == []
+
+
+def test_new_version_replaces_file(data_dir, monkeypatch):
+    fetch(monkeypatch)
+    fresh = CONTENT + "ЖК Тест 2;6000000\n".encode()
+    updated, _ = fetch(monkeypatch, content=fresh)
+    assert updated is True
+    assert (data_dir / "data.csv").read_bytes() == fresh
+    assert json.loads((data_dir / "data.csv.meta.json").read_text())["md5"] == hashlib.md5(fresh).hexdigest()
+    assert leftovers(data_dir) == []